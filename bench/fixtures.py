@@ -0,0 +1,193 @@
+"""\
+Generates the benchmark corpus: a mini LDraw library (bench/ldraw) and the
+models that exercise it (bench/models). The output is checked in, so the
+corpus only changes when this script does.
+
+Usage:
+    python bench/fixtures.py
+"""
+
+import os, math
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LIBRARY = os.path.join(HERE, "ldraw")
+MODELS = os.path.join(HERE, "models")
+
+LDCONFIG = """\
+0 LDraw.org Configuration File (benchmark subset)
+0 Name: LDConfig.ldr
+0 !COLOUR Black CODE 0 VALUE #1B2A34 EDGE #808080
+0 !COLOUR Blue CODE 1 VALUE #1E5AA8 EDGE #333333
+0 !COLOUR Red CODE 4 VALUE #B40000 EDGE #333333
+0 !COLOUR Dark_Grey CODE 8 VALUE #6B5A5A EDGE 72
+0 !COLOUR Yellow CODE 14 VALUE #FAC80A EDGE #333333
+0 !COLOUR White CODE 15 VALUE #F4F4F4 EDGE #333333
+0 !COLOUR Light_Bluish_Grey CODE 71 VALUE #A0A5A9 EDGE #333333
+0 !COLOUR Dark_Bluish_Grey CODE 72 VALUE #6C6E68 EDGE #333333
+0 !COLOUR Trans_Clear CODE 47 VALUE #FCFCFC EDGE #C3C3C3 ALPHA 128
+0 !COLOUR Chrome_Silver CODE 383 VALUE #CED3D6 EDGE #A4A4A4 CHROME
+0 !COLOUR Main_Colour CODE 16 VALUE #FFFF80 EDGE #333333
+0 !COLOUR Edge_Colour CODE 24 VALUE #7F7F7F EDGE #333333
+"""
+
+def num(x):
+    x = round(x, 4)
+    return "0" if x == 0 else "{0:g}".format(x)
+
+def pt(*coords):
+    return " ".join(num(c) for c in coords)
+
+def header(title, name, certify=True):
+    lines = ["0 " + title, "0 Name: " + name, "0 Author: blender-ldraw benchmark"]
+    if certify:
+        lines.append("0 BFC CERTIFY CCW")
+    return lines
+
+def ring(segments):
+    return [(math.cos(2*math.pi*i/segments), math.sin(2*math.pi*i/segments)) for i in range(segments+1)]
+
+def cylinder(segments):
+    # Radius 1, from y=0 to y=1, with conditional lines along every seam
+    lines = header("Cylinder 1.0", "4-4cyli.dat")
+    r = ring(segments)
+    for i in range(segments):
+        (x0, z0), (x1, z1) = r[i], r[i+1]
+        lines.append("4 16 " + pt(x1, 1, z1, x1, 0, z1, x0, 0, z0, x0, 1, z0))
+    for i in range(segments):
+        (xp, zp), (x0, z0), (xn, zn) = r[i-1 if i else segments-1], r[i], r[i+1]
+        lines.append("5 24 " + pt(x0, 1, z0, x0, 0, z0, xp, 1, zp, xn, 1, zn))
+    return lines
+
+def disc(segments):
+    lines = header("Disc 1.0", "4-4disc.dat")
+    r = ring(segments)
+    for i in range(segments):
+        (x0, z0), (x1, z1) = r[i], r[i+1]
+        lines.append("3 16 " + pt(0, 0, 0, x0, 0, z0, x1, 0, z1))
+    return lines
+
+def edge(segments):
+    lines = header("Circle 1.0", "4-4edge.dat", certify=False)
+    r = ring(segments)
+    for i in range(segments):
+        (x0, z0), (x1, z1) = r[i], r[i+1]
+        lines.append("2 24 " + pt(x0, 0, z0, x1, 0, z1))
+    return lines
+
+def box5():
+    # Unit box without its bottom: top face at y=0, open at y=1
+    lines = header("Box with 5 Faces and All Edges", "box5.dat")
+    lines += ["4 16 " + pt(1, 0, 1, 1, 0, -1, -1, 0, -1, -1, 0, 1),
+              "4 16 " + pt(1, 1, 1, 1, 0, 1, -1, 0, 1, -1, 1, 1),
+              "4 16 " + pt(-1, 1, -1, -1, 0, -1, 1, 0, -1, 1, 1, -1),
+              "4 16 " + pt(-1, 1, 1, -1, 0, 1, -1, 0, -1, -1, 1, -1),
+              "4 16 " + pt(1, 1, -1, 1, 0, -1, 1, 0, 1, 1, 1, 1)]
+    corners = [(1, 1), (1, -1), (-1, -1), (-1, 1)]
+    for i in range(4):
+        (x0, z0), (x1, z1) = corners[i], corners[(i+1) % 4]
+        lines.append("2 24 " + pt(x0, 0, z0, x1, 0, z1))
+        lines.append("2 24 " + pt(x0, 1, z0, x1, 1, z1))
+        lines.append("2 24 " + pt(x0, 0, z0, x0, 1, z0))
+    return lines
+
+def stud():
+    lines = header("Stud", "stud.dat")
+    lines += ["1 16 0 -4 0 6 0 0 0 1 0 0 0 6 4-4edge.dat",
+              "1 16 0 0 0 6 0 0 0 1 0 0 0 6 4-4edge.dat",
+              "1 16 0 -4 0 6 0 0 0 4 0 0 0 6 4-4cyli.dat",
+              "1 16 0 -4 0 6 0 0 0 1 0 0 0 6 4-4disc.dat"]
+    return lines
+
+def studGrid(columns, rows):
+    return ["1 16 {0} 0 {1} 1 0 0 0 1 0 0 0 1 stud.dat".format(
+                num(10*(2*i-columns+1)), num(10*(2*j-rows+1)))
+            for i in range(columns) for j in range(rows)]
+
+def brick():
+    lines = header("Brick  2 x  4", "3001.dat")
+    lines.append("1 16 0 0 0 40 0 0 0 24 0 0 0 20 box5.dat")
+    lines += studGrid(4, 2)
+    lines.append("1 16 0 0 0 1 0 0 0 1 0 0 0 1 s\\3001s01.dat")
+    return lines
+
+def brickUnderside():
+    lines = header("~Brick  2 x  4 without Front Face", "s\\3001s01.dat")
+    for x in (-20, 0, 20):
+        lines.append("1 16 {0} 4 0 8 0 0 0 20 0 0 0 8 4-4cyli.dat".format(x))
+        lines.append("1 16 {0} 24 0 8 0 0 0 1 0 0 0 8 4-4edge.dat".format(x))
+    return lines
+
+def plate():
+    lines = header("Plate  1 x  1", "3024.dat")
+    lines.append("1 16 0 0 0 10 0 0 0 8 0 0 0 10 box5.dat")
+    lines += studGrid(1, 1)
+    return lines
+
+def baseplate(size):
+    lines = header("Baseplate {0} x {0} (benchmark)".format(size), "bench-baseplate.dat")
+    lines.append("1 16 0 0 0 {0} 0 0 0 3 0 0 0 {0} box5.dat".format(size*10))
+    lines += studGrid(size, size)
+    return lines
+
+def baseplateModel():
+    lines = ["0 Stud-grid baseplate", "0 Name: baseplate.ldr",
+             "1 2 0 0 0 1 0 0 0 1 0 0 0 1 bench-baseplate.dat"]
+    for i, color in enumerate((4, 1, 14, 15)):
+        lines.append("1 {0} {1} -24 0 1 0 0 0 1 0 0 0 1 3001.dat".format(color, 100*i-150))
+    return lines
+
+def repeatedModel(count):
+    # Many copies of the same few parts: every tenth turned a quarter, every
+    # fiftieth mirrored
+    lines = ["0 Repeated bricks", "0 Name: repeated.ldr"]
+    colors = (1, 4, 14, 15, 0, 71, 47, 383)
+    for i in range(count):
+        x, z, y = 80*(i % 40), 40*((i//40) % 25), -24*(i//1000)
+        if i % 50 == 0:
+            matrix = "-1 0 0 0 1 0 0 0 1"
+        elif i % 10 == 0:
+            matrix = "0 0 1 0 1 0 -1 0 0"
+        else:
+            matrix = "1 0 0 0 1 0 0 0 1"
+        part = "3024.dat" if i % 7 == 0 else "3001.dat"
+        lines.append("1 {0} {1} {2} {3} {4} {5}".format(colors[i % len(colors)], x, y, z, matrix, part))
+    return lines
+
+def deepModel(depth):
+    # Each submodel places the next one twice, so the leaves are instanced
+    # 2**depth times
+    lines = []
+    for level in range(depth):
+        lines += ["0 FILE level{0}.ldr".format(level), "0 Submodel level {0}".format(level)]
+        if level+1 < depth:
+            lines.append("1 16 0 0 0 1 0 0 0 1 0 0 0 1 level{0}.ldr".format(level+1))
+            lines.append("1 16 {0} 0 0 1 0 0 0 1 0 0 0 1 level{1}.ldr".format(80 << (depth-level-2), level+1))
+        else:
+            for i, color in enumerate((4, 1, 14, 16)):
+                lines.append("1 {0} 0 {1} 0 1 0 0 0 1 0 0 0 1 3001.dat".format(color, -24*i))
+        lines.append("0 NOFILE")
+    return lines
+
+def write(path, lines):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', newline='\r\n') as f:
+        f.write("\n".join(lines) + "\n")
+
+def main():
+    write(os.path.join(LIBRARY, "LDConfig.ldr"), LDCONFIG.splitlines())
+    for directory, segments in (("p", 16), (os.path.join("p", "48"), 48), (os.path.join("p", "8"), 8)):
+        write(os.path.join(LIBRARY, directory, "4-4cyli.dat"), cylinder(segments))
+        write(os.path.join(LIBRARY, directory, "4-4disc.dat"), disc(segments))
+        write(os.path.join(LIBRARY, directory, "4-4edge.dat"), edge(segments))
+    write(os.path.join(LIBRARY, "p", "box5.dat"), box5())
+    write(os.path.join(LIBRARY, "p", "stud.dat"), stud())
+    write(os.path.join(LIBRARY, "parts", "3001.dat"), brick())
+    write(os.path.join(LIBRARY, "parts", "s", "3001s01.dat"), brickUnderside())
+    write(os.path.join(LIBRARY, "parts", "3024.dat"), plate())
+    write(os.path.join(LIBRARY, "parts", "bench-baseplate.dat"), baseplate(32))
+    write(os.path.join(MODELS, "baseplate.ldr"), baseplateModel())
+    write(os.path.join(MODELS, "repeated.ldr"), repeatedModel(4000))
+    write(os.path.join(MODELS, "deep.mpd"), deepModel(8))
+
+if __name__ == "__main__":
+    main()
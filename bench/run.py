@@ -0,0 +1,252 @@
+"""\
+Import benchmark over the fixed corpus in bench/ (see fixtures.py).
+
+For every case it records wall time, peak memory, the number of objects,
+meshes, materials and collections created, and the time spent in each
+import phase, then compares them against a stored baseline. Counts must
+match exactly; times and memory may grow by --tolerance before they are
+reported as regressions, and the script exits with status 1.
+
+Usage:
+    blender -b --factory-startup --python bench/run.py -- [options]
+    python bench/run.py --blender /path/to/blender [options]
+    python bench/run.py --core [options]
+
+Inside Blender all cases run in one session, so peak memory is the highest
+seen so far. With --blender every case gets a Blender process of its own.
+--core times only parsing and merging parts, without Blender.
+
+Options:
+    --case NAME          run only this case (repeatable)
+    --baseline PATH      baseline to compare against (bench/baseline.json)
+    --update-baseline    store the results as the new baseline
+    --counts-only        with --update-baseline, store only the counts, which
+                         are the same on every machine
+    --tolerance F        allowed slowdown, as a fraction (0.25)
+    --output PATH        also write the results to this file
+"""
+
+import sys, os, time, json, argparse, subprocess, tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+LIBRARY = os.path.join(HERE, "ldraw")
+MODELS = os.path.join(HERE, "models")
+BASELINE = os.path.join(HERE, "baseline.json")
+
+sys.path.insert(0, ROOT)
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+# name: (model, operator options, import once before timing with a warm cache)
+CASES = {
+    "baseplate": ("baseplate.ldr", {}, False),
+    "baseplate-unmerged": ("baseplate.ldr", {"mergePartsProp": False}, False),
+    "deep-mpd": ("deep.mpd", {}, False),
+    "repeated": ("repeated.ldr", {}, False),
+    "repeated-instanced": ("repeated.ldr", {"instanceProp": True}, False),
+    "repeated-cached": ("repeated.ldr", {"cacheProp": True}, True),
+    "repeated-proxies": ("repeated.ldr", {"proxyProp": True}, False),
+    "repeated-baked": ("repeated.ldr", {"bakeProp": True}, False),
+}
+
+# Cases that differ only in Blender-side options are the same without Blender
+CORECASES = ("baseplate", "baseplate-unmerged", "deep-mpd", "repeated")
+
+DEFAULTS = {"ldrawPathProp": LIBRARY, "cacheProp": False, "workersProp": 0}
+
+COUNTS = ("objects", "meshes", "materials", "collections", "parts", "faces", "verts")
+# Phases shorter than this are too noisy to compare
+MINSECONDS = 0.05
+
+def peakMemory():
+    """Peak resident memory of this process, in KiB."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak//1024 if sys.platform == 'darwin' else peak
+
+def phaseTimes(report, wall):
+    phases = {name: phase['seconds'] for name, phase in report['phases'].items()}
+    # Whatever no phase accounts for, such as readFile's own bookkeeping
+    phases['other'] = max(0.0, wall-sum(phases.values()))
+    return phases
+
+### BLENDER ###
+
+def importModel(path, options, profile):
+    bpy.ops.import_scene.ldraw_dat(filepath=path, profileProp=profile, **dict(DEFAULTS, **options))
+
+def blenderCase(name):
+    model, options, warm = CASES[name]
+    path = os.path.join(MODELS, model)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['LDRAW_CACHE_DIR'] = os.path.join(tmp, "cache")
+        profile = os.path.join(tmp, "profile.json")
+        if warm:
+            bpy.ops.wm.read_homefile(use_empty=True)
+            importModel(path, options, profile)
+        bpy.ops.wm.read_homefile(use_empty=True)
+        start = time.perf_counter()
+        importModel(path, options, profile)
+        wall = time.perf_counter()-start
+        with open(profile) as f:
+            report = json.load(f)
+    return {"wall": wall,
+            "peakMemoryKB": peakMemory(),
+            "objects": len(bpy.data.objects),
+            "meshes": len(bpy.data.meshes),
+            "materials": len(bpy.data.materials),
+            "collections": len(bpy.data.collections),
+            "phases": phaseTimes(report, wall)}
+
+def blenderCases(names):
+    import ldraw
+    if not hasattr(bpy.types, "IMPORT_SCENE_OT_ldraw_dat"):
+        ldraw.register()
+    return {name: blenderCase(name) for name in names}
+
+def spawnCases(names, blender):
+    results = {}
+    for name in names:
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "results.json")
+            subprocess.run([blender, "-b", "--factory-startup", "--python", os.path.abspath(__file__),
+                            "--", "--case", name, "--output", output, "--no-compare"], check=True)
+            with open(output) as f:
+                results.update(json.load(f)["cases"])
+    return results
+
+### CORE ###
+
+def coreCase(name):
+    import tracemalloc
+    import ldrawcore
+    model, options, warm = CASES[name]
+    merge = options.get("mergePartsProp", True)
+    ldrawcore.PROFILE = ldrawcore.Profile()
+    tracemalloc.start()
+    start = time.perf_counter()
+    library = ldrawcore.Library(LIBRARY, tolerance=ldrawcore.THRESHOLD, index=ldrawcore.LibraryIndex(LIBRARY))
+    mpd = ldrawcore.MPDFile.open(os.path.join(MODELS, model), tolerance=ldrawcore.THRESHOLD)
+
+    def load(fname):
+        # Submodels come from the model itself, like loadModel does in Blender
+        return (mpd[fname], model) if fname in mpd else library.load(fname)
+
+    if merge:
+        # Whole parts, each merged into one mesh
+        parts = ldrawcore.scanParts(mpd.firstName, load, library.isPart)
+        memo = {}
+        meshes = [ldrawcore.flatten(part, load, library.isPart, memo=memo) for part in sorted(parts)]
+    else:
+        # Every file that gets a mesh of its own
+        parts = set()
+        pending = [mpd.firstName]
+        while pending:
+            fname = pending.pop()
+            if fname not in parts and load(fname)[0] is not None:
+                parts.add(fname)
+                pending.extend(load(fname)[0].refNames)
+        meshes = [ldrawcore.FlatMesh.fromFile(load(part)[0]) for part in sorted(parts)]
+    wall = time.perf_counter()-start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"wall": wall,
+            "peakMemoryKB": peak//1024,
+            "parts": len(parts),
+            "faces": sum(len(flat.faceSizes) for flat in meshes),
+            "verts": sum(flat.vertCount for flat in meshes),
+            "phases": phaseTimes(ldrawcore.PROFILE.report(), wall)}
+
+### COMPARISON ###
+
+def compare(results, baseline, tolerance):
+    """Regressions of results against baseline, as messages."""
+    problems = []
+    for name, result in sorted(results.items()):
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        for key in COUNTS:
+            if key in expected and result.get(key) != expected[key]:
+                problems.append("{0}: {1} changed from {2} to {3}".format(name, key, expected[key], result.get(key)))
+        for key in ("wall", "peakMemoryKB"):
+            if expected.get(key) and result.get(key) and result[key] > expected[key]*(1+tolerance):
+                problems.append("{0}: {1} grew from {2:.4g} to {3:.4g}".format(name, key, expected[key], result[key]))
+        for phase, seconds in sorted(result["phases"].items()):
+            before = expected.get("phases", {}).get(phase)
+            if before is not None and seconds > max(before*(1+tolerance), before+MINSECONDS):
+                problems.append("{0}: phase {1} grew from {2:.4f} to {3:.4f} seconds".format(name, phase, before, seconds))
+    return problems
+
+def summary(results):
+    lines = []
+    for name, result in sorted(results.items()):
+        counts = ", ".join("{0} {1}".format(result[key], key) for key in COUNTS if key in result)
+        lines.append("{0:<20} {1:8.3f} s  {2:>9} KiB  {3}".format(
+            name, result["wall"], result["peakMemoryKB"] or "?", counts))
+        for phase, seconds in sorted(result["phases"].items(), key=lambda item: -item[1]):
+            lines.append("    {0:<12} {1:8.4f} s".format(phase, seconds))
+    return "\n".join(lines)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="LDraw import benchmark")
+    parser.add_argument("--case", action="append", choices=sorted(CASES))
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--counts-only", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--output")
+    parser.add_argument("--blender")
+    parser.add_argument("--core", action="store_true")
+    parser.add_argument("--no-compare", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    names = args.case or sorted(CORECASES if args.core else CASES)
+
+    if args.core:
+        mode, results = "core", {name: coreCase(name) for name in names}
+    elif bpy is not None:
+        mode, results = "blender", blenderCases(names)
+    elif args.blender:
+        mode, results = "blender", spawnCases(names, args.blender)
+    else:
+        parser.error("run inside Blender, or pass --blender or --core")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"mode": mode, "cases": results}, f, indent=1)
+    if args.no_compare:
+        return 0
+    print(summary(results))
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    if args.update_baseline:
+        if args.counts_only:
+            results = {name: {key: result[key] for key in COUNTS if key in result}
+                       for name, result in results.items()}
+        baselines.setdefault(mode, {}).update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+        print("Baseline updated: " + args.baseline)
+        return 0
+    if mode not in baselines:
+        print("No {0} baseline in {1}; store one with --update-baseline".format(mode, args.baseline))
+        return 1
+    problems = compare(results, baselines[mode], args.tolerance)
+    for problem in problems:
+        print("REGRESSION " + problem)
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    # Blender passes the script's own arguments after "--"
+    argv = sys.argv[sys.argv.index("--")+1:] if "--" in sys.argv else sys.argv[1:]
+    sys.exit(main(argv))
@@ -0,0 +1,196 @@
+"""\
+Batch converter: imports LDraw models headless and saves each as a .blend.
+
+Every model is converted by a Blender process of its own, with up to
+--jobs of them running at once, so one bad model only fails itself. A JSON
+summary of timings and failures is written at the end.
+
+Usage:
+    python convert.py --blender /path/to/blender [options] MODEL_OR_DIR...
+    blender -b --python convert.py -- [options] MODEL_OR_DIR...
+
+Directories are searched recursively for .ldr and .mpd files. Each .blend
+goes to --output-dir, keeping the layout below the directory it was found
+in, or next to the model if no output directory is given.
+
+Options:
+    --blender PATH       Blender to run (defaults to the running one)
+    --jobs N             Blender processes at once (the number of cores)
+    --output-dir DIR     where to write the .blend files
+    --summary PATH       write the JSON summary here instead of stdout
+    --timeout SECONDS    give up on a model after this long (no limit)
+    --overwrite          convert models whose .blend already exists
+    --ldraw-dir DIR      the LDraw library (the importer's default)
+    --no-smooth, --hires, --lowres, --studless, --seam F, --no-merge,
+    --instances, --no-cache, --bake, --nodes, --no-lights, --no-transform
+                         the importer's options of the same names
+"""
+
+import sys, os, time, json, argparse, subprocess, tempfile, concurrent.futures
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, HERE)
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+EXTENSIONS = ('.ldr', '.mpd')
+
+def findModels(paths, outputDir):
+    """(model, .blend) pairs for every model in paths."""
+    jobs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() in EXTENSIONS:
+                        model = os.path.join(root, name)
+                        jobs.append((model, os.path.relpath(model, path)))
+        else:
+            jobs.append((path, os.path.basename(path)))
+    return [(model, os.path.splitext(os.path.join(outputDir, rel) if outputDir else model)[0] + '.blend')
+            for model, rel in jobs]
+
+def importOptions(args):
+    # Operator properties of ImportLdraw
+    options = {"smoothProp": not args.no_smooth,
+               "hiResProp": args.hires,
+               "lowResProp": args.lowres,
+               "studlessProp": args.studless,
+               "mergePartsProp": not args.no_merge,
+               "instanceProp": args.instances,
+               "cacheProp": not args.no_cache,
+               "bakeProp": args.bake,
+               "nodesProp": args.nodes,
+               "lightProp": not args.no_lights,
+               "transformProp": not args.no_transform}
+    if args.ldraw_dir:
+        options["ldrawPathProp"] = os.path.abspath(args.ldraw_dir)
+    if args.seam is not None:
+        options["scaleProp"] = args.seam
+    return options
+
+### WORKER ###
+
+def convertModel(model, blend, options, output):
+    # Runs inside Blender, for one model
+    import ldraw
+    if not hasattr(bpy.types, "IMPORT_SCENE_OT_ldraw_dat"):
+        ldraw.register()
+    bpy.ops.wm.read_homefile(use_empty=True)
+    start = time.perf_counter()
+    bpy.ops.import_scene.ldraw_dat(filepath=model, **options)
+    imported = time.perf_counter()-start
+    os.makedirs(os.path.dirname(os.path.abspath(blend)), exist_ok=True)
+    bpy.ops.wm.save_as_mainfile(filepath=os.path.abspath(blend))
+    with open(output, 'w') as f:
+        json.dump({"importSeconds": imported,
+                   "saveSeconds": time.perf_counter()-start-imported,
+                   "objects": len(bpy.data.objects),
+                   "meshes": len(bpy.data.meshes),
+                   "materials": len(bpy.data.materials)}, f)
+
+### BATCH ###
+
+def runModel(blender, model, blend, options, timeout):
+    result = {"model": model, "blend": blend}
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, "result.json")
+        command = [blender, "-b", "--factory-startup", "--python-exit-code", "1",
+                   "--python", os.path.abspath(__file__), "--",
+                   "--worker", os.path.abspath(model), os.path.abspath(blend), json.dumps(options), output]
+        try:
+            process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     timeout=timeout, universal_newlines=True, errors='replace')
+        except subprocess.TimeoutExpired:
+            result["error"] = "timed out after {0} seconds".format(timeout)
+        except OSError as e:
+            result["error"] = str(e)
+        else:
+            if process.returncode == 0 and os.path.exists(output):
+                with open(output) as f:
+                    result.update(json.load(f))
+            else:
+                lines = process.stdout.strip().splitlines()
+                result["error"] = "exit status {0}".format(process.returncode)
+                result["log"] = lines[-20:]
+    result["seconds"] = time.perf_counter()-start
+    return result
+
+def runBatch(jobs, blender, options, workers, timeout):
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(runModel, blender, model, blend, options, timeout) for model, blend in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print("{0:>5}/{1} {2} {3} ({4:.1f} s)".format(len(results), len(jobs),
+                  "FAILED" if "error" in result else "ok", result["model"], result["seconds"]),
+                  file=sys.stderr)
+    return sorted(results, key=lambda result: result["model"])
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Convert LDraw models to .blend files")
+    parser.add_argument("paths", nargs="*")
+    parser.add_argument("--blender")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--output-dir")
+    parser.add_argument("--summary")
+    parser.add_argument("--timeout", type=float)
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--ldraw-dir")
+    parser.add_argument("--no-smooth", action="store_true")
+    parser.add_argument("--hires", action="store_true")
+    parser.add_argument("--lowres", action="store_true")
+    parser.add_argument("--studless", action="store_true")
+    parser.add_argument("--seam", type=float)
+    parser.add_argument("--no-merge", action="store_true")
+    parser.add_argument("--instances", action="store_true")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--bake", action="store_true")
+    parser.add_argument("--nodes", action="store_true")
+    parser.add_argument("--no-lights", action="store_true")
+    parser.add_argument("--no-transform", action="store_true")
+    parser.add_argument("--worker", nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        model, blend, options, output = args.worker
+        convertModel(model, blend, json.loads(options), output)
+        return 0
+
+    blender = args.blender or (bpy.app.binary_path if bpy is not None else None)
+    if not blender:
+        parser.error("pass --blender, or run inside Blender")
+    if not args.paths:
+        parser.error("no models given")
+    jobs = findModels(args.paths, args.output_dir)
+    skipped = [] if args.overwrite else [model for model, blend in jobs if os.path.exists(blend)]
+    jobs = [(model, blend) for model, blend in jobs if model not in skipped]
+
+    start = time.perf_counter()
+    results = runBatch(jobs, blender, importOptions(args), max(1, args.jobs), args.timeout)
+    failed = [result for result in results if "error" in result]
+    summary = {"seconds": time.perf_counter()-start,
+               "converted": len(results)-len(failed),
+               "failed": len(failed),
+               "skipped": skipped,
+               "options": importOptions(args),
+               "models": results}
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=1)
+    else:
+        json.dump(summary, sys.stdout, indent=1)
+        print()
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    # Blender passes the script's own arguments after "--"
+    argv = sys.argv[sys.argv.index("--")+1:] if "--" in sys.argv else sys.argv[1:]
+    sys.exit(main(argv))
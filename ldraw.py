@@ -27,16 +27,40 @@ Usage:
     tooltips), and click Import.
 """
 
-import bpy, bpy.props, bpy.utils, mathutils, bmesh
-import sys, os, math, time, warnings
+import bpy, bpy.props, bpy.utils, mathutils
+import sys, os, math, time, json, warnings, bisect, traceback, hashlib
+import numpy
+
+try:
+    import ldrawcore
+except ImportError:
+    # Running from a text block or an unusual install location
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import ldrawcore
+from ldrawcore import BFCContext, THRESHOLD
 
 DEFAULTMAT = mathutils.Matrix.Scale(0.025, 4)
 DEFAULTMAT @= mathutils.Matrix.Rotation(math.pi/-2.0, 4, 'X') # -90 degree rotation
-THRESHOLD = 0.0001
-CW = 0
-CCW = 1
 MAXPATH = 1024
+# Bytes of a zipped library kept decompressed in memory, with Cache parts on
+ARCHIVECACHE = 64 << 20
 LOWRES = False
+STUDLESS = False
+WELDTHRESHOLD = THRESHOLD
+# Face attribute marking faces that are only seen from the front
+CULLATTRIBUTE = "ldrawCull"
+# Boolean and color face attributes are only there from Blender 2.92 on
+FACEATTRIBUTES = bpy.app.version >= (2, 92, 0)
+# Conditional lines across which the surface bends more than this are creases
+CREASEANGLE = math.radians(60.0)
+INSTANCES = False
+USECACHE = True
+WORKERS = 0
+PROFILEPATH = ""
+INCREMENTAL = False
+PROXIES = False
+NODEMATERIALS = False
+BAKE = False
 
 ### UTILITY FUNCTIONS ###
 
@@ -63,6 +87,7 @@ def parseColorLine(ls, keys, flags=set()):
             s.add(val)
     return d, s
 
+@ldrawcore.profiled('linking')
 def copyAndApplyMaterial(o, mat):
     """
     Copies and object AND all of its children. Links children to the current
@@ -87,7 +112,7 @@ def copyAndApplyMaterial(o, mat):
         else:
             d = copyAndApplyMaterial(c, None)
             d.ldrawInheritsColor = False
-        bpy.context.scene.collection.objects.link(d)
+        COLLECTION.objects.link(d)
         d.parent = p
     return p
 
@@ -100,41 +125,11 @@ def matrixEqual(a, b, threshold=THRESHOLD):
                 return False
     return True
 
-class BFCContext(object):
-    def __init__(self, other=None, copy=False):
-        if copy:
-            self.localCull = other.localCull
-            self.winding = other.winding
-            self.invertNext = other.invertNext
-            self.certified = other.certified
-            self.accumCull = other.accumCull
-            self.accumInvert = other.accumInvert
-        else:
-            self.localCull = True
-            self.winding = CCW
-            self.invertNext = False
-            self.certified = None
-            if other is not None and other.certified:
-                self.certified = True
-                self.accumCull = other.accumCull and other.localCull
-                self.accumInvert = other.accumInvert ^ other.invertNext
-            else:
-                self.accumCull = False
-                self.accumInvert = False
-
 def setMeshSmooth(me):
-    for mp in me.faces:
-        mp.smooth = True
+    me.polygons.foreach_set("use_smooth", numpy.ones(len(me.polygons), dtype=bool))
 
-partsCache = set()
 def isAPart(name):
-    if name in partsCache:
-        return True
-    elif os.path.exists(os.path.join(LDRAWDIR, "parts", name)):
-        partsCache.add(name)
-        return True
-    else:
-        return False
+    return LIBRARY.isPart(name)
 
 def srgbToLinearrgb(c):
     """
@@ -174,21 +169,25 @@ def parseColorAttributes(line, extraAttribs={}):
     return attribs, flags, materialName, materialAttribs, materialFlags
 
 def doMaterialFreestyle(mat, attribs):
+    if 'EDGE' not in attribs:
+        # Direct colors have none
+        return
     edge = attribs['EDGE']
     if edge[0] == '#':
         mat.line_color = srgbToLinearrgbV3V3(hex2rgb(edge))+(1.0,)
     elif edge.isdigit():
-        # References another color
+        # References another color, which is looked up in the palette, so it
+        # doesn't matter whether it is defined (or used) yet
         edge = int(edge)
-        if edge in MATERIALS:
-            mat.line_color = MATERIALS[edge].diffuse_color
+        if edge in PALETTE:
+            edgeAttribs = parseColorAttributes(PALETTE[edge][1])[0]
+            mat.line_color = srgbToLinearrgbV3V3(hex2rgb(edgeAttribs['VALUE']))+(1.0,)
         else:
-            # TODO: The color may not have been defined yet, so we should
-            # postpone edge color lookups until the end
             warnings.warn("Undefined color {0}".format(edge))
     else:
         warnings.warn("Malformed edge color reference: {0}".format(edge))
 
+@ldrawcore.profiled('materials')
 def createMaterial(name, line, extraAttribs={}):
     global MATERIALS
     
@@ -204,15 +203,18 @@ def createMaterial(name, line, extraAttribs={}):
         if materialId in (16, 24):
             return None # Not allowed to use these colors directly
     
-    if name in bpy.data.materials:
+    alpha = int(attribs.get('ALPHA', 255))
+    
+    if NODEMATERIALS:
+        mat = nodeMaterial(name, materialFinish(alpha, flags))
+    elif name in bpy.data.materials:
+        # Left with or without nodes, however it was made
         mat = bpy.data.materials[name]
     else:
         mat = bpy.data.materials.new(name)
+        mat.use_nodes = False
     MATERIALS[materialId] = mat
     
-    mat.use_nodes = False
-    
-    alpha = int(attribs.get('ALPHA', 255))
     mat.diffuse_color = value+(alpha/255.0,)
     
     if hasattr(mat, 'line_color'):
@@ -220,7 +222,14 @@ def createMaterial(name, line, extraAttribs={}):
         doMaterialFreestyle(mat, attribs)
     
     doMaterialBase(mat, alpha, attribs, flags, materialName, materialAttribs, materialFlags)
-    #doMaterialCycles(mat, value, alpha, attribs, flags, materialName, materialAttribs, materialFlags)
+    if NODEMATERIALS:
+        bsdf = mat.node_tree.nodes["LDraw BSDF"]
+        bsdf.inputs["Base Color"].default_value = value+(1.0,)
+        # ALPHA is the color's opacity; the rest of the light goes through
+        for inputName in ('Transmission', 'Transmission Weight'):
+            if inputName in bsdf.inputs:
+                bsdf.inputs[inputName].default_value = 1.0-alpha/255.0
+                break
     
     return mat
 
@@ -289,151 +298,166 @@ def doMaterialBase(mat, alpha, attribs, flags, materialName, materialAttribs, ma
         mat.show_transparent_back = False
         mat.blend_method = "BLEND"
 
-def doMaterialCycles(mat, value, alpha, attribs, flags, materialName, materialAttribs, materialFlags):
+# Principled BSDF settings of each finish. Input names changed in Blender 4.0,
+# so each setting lists every name it has had
+FINISHES = {
+    'SOLID': {('Metallic',): 0.0, ('Roughness',): 0.3},
+    'TRANSPARENT': {('Metallic',): 0.0, ('Roughness',): 0.05, ('IOR',): 1.58},
+    'CHROME': {('Metallic',): 1.0, ('Roughness',): 0.05},
+    'PEARLESCENT': {('Metallic',): 0.4, ('Roughness',): 0.25},
+    'METAL': {('Metallic',): 1.0, ('Roughness',): 0.2},
+    'RUBBER': {('Metallic',): 0.0, ('Roughness',): 0.9, ('Specular', 'Specular IOR Level'): 0.1},
+    'MATTE_METALLIC': {('Metallic',): 0.8, ('Roughness',): 0.5},
+}
+
+def materialFinish(alpha, flags):
+    """
+    >>> materialFinish(255, {'CHROME'}), materialFinish(128, set()), materialFinish(255, set())
+    ('CHROME', 'TRANSPARENT', 'SOLID')
+    """
+    for finish in ('CHROME', 'PEARLESCENT', 'RUBBER', 'MATTE_METALLIC', 'METAL'):
+        if finish in flags:
+            return finish
+    return 'TRANSPARENT' if alpha < 255 else 'SOLID'
+
+def templateMaterial(finish):
+    # Built once per finish; every color of that finish is a copy
+    name = ".LDraw {0}".format(finish.title().replace('_', ' '))
+    mat = bpy.data.materials.get(name)
+    if mat is not None and mat.get('ldrawFinish') == finish:
+        return mat
+    mat = bpy.data.materials.new(name)
+    mat['ldrawFinish'] = finish
     mat.use_nodes = True
     tree = mat.node_tree
     tree.nodes.clear()
-    shout = tree.nodes.new('ShaderNodeOutputMaterial')
-    if "CHROME" in flags:
-        pass
-    elif "PEARLESCENT" in flags:
-        pass
-    elif "RUBBER" in flags:
-        pass
-    elif "MATTE_METALLIC" in flags:
-        pass
-    elif "METAL" in flags:
-        pass
-    elif alpha < 224:
-        mix = tree.nodes.new('ShaderNodeMixShader')
-        mix.inputs['Fac'].default_value = alpha/2047.0
-        
-        refr = tree.nodes.new('ShaderNodeBsdfRefraction')
-        refr.inputs['Color'].default_value = value+(1.0,)
-        refr.inputs['Roughness'].default_value = 0.0
-        refr.inputs['IOR'].default_value = 1.40
-        tree.links.new(refr.outputs['BSDF'], mix.inputs[1])
-        
-        gloss = tree.nodes.new('ShaderNodeBsdfGlossy')
-        gloss.inputs['Color'].default_value = (1.0,1.0,1.0,1.0)
-        gloss.inputs['Roughness'].default_value = 0.0
-        tree.links.new(gloss.outputs['BSDF'], mix.inputs[2])
-        
-        tree.links.new(mix.outputs['Shader'], shout.inputs['Surface'])
-    elif alpha < 255:
-        pass
-    else:
-        mix = tree.nodes.new('ShaderNodeMixShader')
-        mix.inputs['Fac'].default_value = 0.0625
-        
-        diff = tree.nodes.new('ShaderNodeBsdfDiffuse')
-        diff.inputs['Color'].default_value = value+(1.0,)
-        diff.inputs['Roughness'].default_value = 0.0
-        tree.links.new(diff.outputs['BSDF'], mix.inputs[1])
-        
-        gloss = tree.nodes.new('ShaderNodeBsdfGlossy')
-        gloss.inputs['Color'].default_value = (1.0,1.0,1.0,1.0)
-        gloss.inputs['Roughness'].default_value = 0.0
-        tree.links.new(gloss.outputs['BSDF'], mix.inputs[2])
-        
-        tree.links.new(mix.outputs['Shader'], shout.inputs['Surface'])
-
-def lineType0(line, bfc, someObj=None):
-    # Comment or meta-command
-    if len(line) < 2:
-        return
-    if line[1] in ('WRITE', 'PRINT'):
-        pass
-    elif line[1] == 'CLEAR':
-        #bpy.ops.wm.redraw_timer()
-        pass
-    elif line[1] == 'PAUSE':
-        pass
-    elif line[1] == 'SAVE':
-        #bpy.ops.render.render()
-        pass
-    elif line[1] == '!COLOUR':
-        name = line[2].strip()
-        line = [s.upper() for s in line]
-        createMaterial(name, line)
-
-    elif line[1] == "BFC":
-        # http://www.ldraw.org/article/415
-        if bfc.certified and "NOCERTIFY" not in line:
-            bfc.certified = True
-        for option in line[2:]:
-            if option == "CERTIFY":
-                assert bfc.certified is None or bfc.certified
-                bfc.certified = True
-            elif option == "NOCERTIFY":
-                assert not bfc.certified
-                bfc.certified = False
-            elif option == "CLIP":
-                bfc.localCull = True
-            elif option == "NOCLIP":
-                bfc.localCull = False
-            elif option == "CCW":
-                # According to the spec, winding should alternate depending on
-                # accumInvert. However, for an importer, since accumInvert
-                # depends on the files above in the hierarchy, we should only
-                # use locally-specified winding, then invert when collapsing
-                # the mesh
-                bfc.winding = CCW
-            elif option == "CW":
-                bfc.winding = CW
-            elif option == "INVERTNEXT":
-                bfc.invertNext = True
-
-def colorReference(s):
-    if s.isdigit():
-        materialId = int(s)
-        if materialId in (16, 24):
-            return materialId, None
-        elif materialId in MATERIALS:
-            return materialId, MATERIALS[materialId]
-        else:
-            warnings.warn("Undefined color {0}".format(materialId))
-    elif s.startswith("0x2"):
+    output = tree.nodes.new('ShaderNodeOutputMaterial')
+    bsdf = tree.nodes.new('ShaderNodeBsdfPrincipled')
+    bsdf.name = "LDraw BSDF"
+    bsdf.location = (-300, 0)
+    for names, value in FINISHES[finish].items():
+        for inputName in names:
+            if inputName in bsdf.inputs:
+                bsdf.inputs[inputName].default_value = value
+                break
+    # The back of a single-sided (BFC) face is see-through, in every
+    # render engine, while faces of meshes without CULLATTRIBUTE show both
+    # sides
+    geometry = tree.nodes.new('ShaderNodeNewGeometry')
+    geometry.location = (-600, 300)
+    cull = tree.nodes.new('ShaderNodeAttribute')
+    cull.attribute_name = CULLATTRIBUTE
+    cull.location = (-600, 100)
+    backface = tree.nodes.new('ShaderNodeMath')
+    backface.operation = 'MULTIPLY'
+    backface.location = (-400, 200)
+    transparent = tree.nodes.new('ShaderNodeBsdfTransparent')
+    transparent.location = (-300, -300)
+    mix = tree.nodes.new('ShaderNodeMixShader')
+    mix.location = (0, 0)
+    output.location = (200, 0)
+    tree.links.new(geometry.outputs['Backfacing'], backface.inputs[0])
+    tree.links.new(cull.outputs['Fac'], backface.inputs[1])
+    tree.links.new(backface.outputs['Value'], mix.inputs['Fac'])
+    tree.links.new(bsdf.outputs['BSDF'], mix.inputs[1])
+    tree.links.new(transparent.outputs['BSDF'], mix.inputs[2])
+    tree.links.new(mix.outputs['Shader'], output.inputs['Surface'])
+    if getattr(mat, 'blend_method', None) == 'OPAQUE':
+        # EEVEE before 4.2 ignores transparency on opaque materials
+        mat.blend_method = 'CLIP'
+    return mat
+
+def nodeMaterial(name, finish):
+    """
+    The node material for a color: a copy of its finish's template, unless
+    there already is one of that finish. Only the color is set afterwards.
+    """
+    mat = bpy.data.materials.get(name)
+    if (mat is not None and mat.get('ldrawFinish') == finish and
+            mat.node_tree is not None and "LDraw BSDF" in mat.node_tree.nodes):
+        return mat
+    new = templateMaterial(finish).copy()
+    if mat is not None:
+        # Made without nodes, or with another finish, by an earlier import
+        mat.user_remap(new)
+        bpy.data.materials.remove(mat)
+    new.name = name
+    return new
+
+def colorReference(code):
+    if code in (16, 24):
+        return code, None
+    elif code >= ldrawcore.DIRECTCOLOR:
         # Direct color
-        if s in MATERIALS:
-            return None, MATERIALS[s]
+        if code in MATERIALS:
+            return None, MATERIALS[code]
         else:
-            return None, createMaterial(s, [], {"VALUE": s[3:], "CODE": s})
-    else:
-        warnings.warn("Malformed color reference: {0}".format(s))
+            name = "0x{0:07X}".format(code)
+            return None, createMaterial(name, [], {"VALUE": name[3:], "CODE": str(code)})
+    elif code in MATERIALS:
+        return code, MATERIALS[code]
+    elif code in PALETTE:
+        # Materials are only made for colors in use
+        name, line = PALETTE[code]
+        return code, createMaterial(name, line)
+    elif code != ldrawcore.BADCOLOR:
+        warnings.warn("Undefined color {0}".format(code))
     return None, None
 
-def findMaterialIndex(listOfSlots, material):
-    for idx, slot in enumerate(listOfSlots):
-        if slot.link == "DATA" and slot.material == material:
-            return idx
+def defineColours(colours):
+    # Definitions in the model itself take over from LDConfig.ldr's
+    for code, definition in ldrawcore.colourTable(colours).items():
+        if PALETTE.get(code) != definition:
+            PALETTE[code] = definition
+            MATERIALS.pop(code, None)
 
-def lineType1(line, oldObj, oldMaterial, bfc, subfiles={}, merge=False):
-    # File reference
-    idx = -1
-    for i in range(14):
-        while True:
-            nextSpace = line.find(' ', idx+1)
-            if nextSpace == -1: return
-            if nextSpace > idx+1:
-                idx = nextSpace
-                break
-            idx = nextSpace
-    fname = line[idx+1:].lower()
-    line = line.split()
-    newMatrix = mathutils.Matrix()
-    newMatrix[0][:] = [float(line[ 5]), float(line[ 6]), float(line[ 7]), float(line[2])]
-    newMatrix[1][:] = [float(line[ 8]), float(line[ 9]), float(line[10]), float(line[3])]
-    newMatrix[2][:] = [float(line[11]), float(line[12]), float(line[13]), float(line[4])]
-    newMatrix[3][:] = [           0.0,              0.0,             0.0,            1.0]
-    
-    if newMatrix.determinant() < 0:
-        bfc.invertNext = not bfc.invertNext
-    
-    materialId, material = colorReference(line[1])
+def materialSlots(o):
+    """
+    Maps each material in o's mesh-linked slots to the first slot holding
+    it, so finding a slot doesn't mean walking material_slots every time.
+    """
+    slots = {}
+    for idx, slot in enumerate(o.material_slots):
+        if slot.link == "DATA":
+            slots.setdefault(slot.material, idx)
+    return slots
+
+def referenceMatrix(parsed, refIdx):
+    fname = parsed.refNames[refIdx]
+    m = parsed.refMatrices[refIdx*12:refIdx*12+12]
+    newMatrix = mathutils.Matrix((m[0:4], m[4:8], m[8:12], (0.0, 0.0, 0.0, 1.0)))
+    if isAPart(fname) and not ldrawcore.isSubpart(fname):
+        newMatrix @= GAPMAT
+    return newMatrix
+
+def referenceMaterial(parsed, refIdx, oldMaterial):
+    materialId, material = colorReference(parsed.refColors[refIdx])
     if materialId in (16, 24):
         material = oldMaterial
-    if fname in subfiles:
+    return materialId, material
+
+def lineType1(parsed, refIdx, oldObj, oldMaterial, bfc, subfiles={}, merge=False):
+    # File reference
+    fname = parsed.refNames[refIdx]
+    newMatrix = referenceMatrix(parsed, refIdx)
+    flags = parsed.refFlags[refIdx]
+    bfc.localCull = not flags & ldrawcore.REF_NOCLIP
+    # Only INVERTNEXT counts: Blender already turns the faces of mirrored
+    # objects the right way round
+    bfc.invertNext = bool(flags & ldrawcore.REF_INVERT)
+    
+    materialId, material = referenceMaterial(parsed, refIdx, oldMaterial)
+    if PROXIES and fname not in subfiles and fname != 'light.dat' and isAPart(fname):
+        newObj = proxyObject(fname, material)
+    elif INSTANCES and not (fname == 'light.dat' and USELIGHTS):
+        coll = instanceCollection(fname, material, bfc, subfiles, merge)
+        if coll is None:
+            newObj = None
+        else:
+            newObj = bpy.data.objects.new(coll.name, None)
+            newObj.instance_type = 'COLLECTION'
+            newObj.instance_collection = coll
+    elif fname in subfiles:
         newObj = readFile(fname, BFCContext(bfc), subfiles=subfiles, material=material, merge=merge)
     elif fname == 'light.dat' and USELIGHTS:
         l = bpy.data.lights.new(fname, 'POINT')
@@ -446,260 +470,334 @@ def lineType1(line, oldObj, oldMaterial, bfc, subfiles={}, merge=False):
     else:
         newObj = readFile(fname, BFCContext(bfc), material=material, merge=merge or (MERGEPARTS and isAPart(fname)))
     if newObj:
-        if isAPart(fname):
-            if not ((fname[0] == 's') and (fname[1] in ('/', '\\'))):
-                newMatrix @= GAPMAT
-        newObj.ldrawInheritsColor = materialId in (16, 24)
-        if merge and newObj.type == 'MESH':
-            oldToNewMatMap = {0: 0}
-            for subMatIdx, subMaterialSlot in enumerate(newObj.material_slots):
-                if newObj.ldrawInheritsColor and subMaterialSlot.link == "OBJECT": continue
-                matIdx = findMaterialIndex(oldObj.material_slots, subMaterialSlot.material)
-                if matIdx is None:
-                    oldObj.data.materials.append(subMaterialSlot.material)
-                    oldToNewMatMap[subMatIdx] = len(oldObj.material_slots)-1
-                else:
-                    oldToNewMatMap[subMatIdx] = matIdx
-            bm = bmesh.new()
-            bm.from_mesh(newObj.data, face_normals=False)
-            
-            # Only use invertNext (not accumInvert), since reversals will be
-            # accumulated when collapsing/merging
-            if bfc.invertNext:
-                bmesh.ops.reverse_faces(bm, faces=bm.faces, flip_multires=False)
-            
-            for face in bm.faces:
-                face.material_index = oldToNewMatMap[face.material_index]
-            bm.transform(newMatrix)
-            bm.from_mesh(oldObj.data, face_normals=False)
-            bm.to_mesh(oldObj.data)
-            bm.free()
-            childData = newObj.data
-            #bpy.data.objects.remove(newObj)
-            #bpy.data.meshes.remove(childData)
-        else:
-            bpy.context.scene.collection.objects.link(newObj)
+        ldrawcore.PROFILE.count(fname, 'references')
+        with ldrawcore.PROFILE.phase('linking'):
+            newObj.ldrawInheritsColor = materialId in (16, 24)
+            newObj.ldrawFile = fname
+            COLLECTION.objects.link(newObj)
             newObj.parent = oldObj
             newObj.matrix_local = newMatrix
             if not matrixEqual(newMatrix, newObj.matrix_local):
                 warnings.warn("Object matrix has changed, model may have errors!")
 
-def findVert(bm, loc):
-    for bv in bm.verts:
-        if bv.co == loc: return bv
-    return bm.verts.new(loc)
-
-def poly(line, bm, bfc):
-    # helper function for making polygons
-    vertices = []
-    for i in range(0, len(line), 3):
-        vertices.append(findVert(bm, mathutils.Vector((float(line[i]), float(line[i+1]), float(line[i+2])))))
-    if bfc.winding == CW:
-        vertices.reverse()
-    return bm.faces.new(vertices)
-
-def readLine(line, o, material, bfc, bm, subfiles={}, readLater=None, merge=False):
-    # Returns True if the file references any files or contains any polys;
-    # otherwise, it is likely a header file and can be ignored.
-    line = line.strip()
-    if len(line) == 0:
-        return False
-    command = line[:max(line.find(' '), 1)]
-    if command == '0':
-        # Comment or meta-command
-        sline = line.split()
-        lineType0(sline, bfc)
-        if len(sline) < 2 or sline[1] != "BFC":
-            bfc.invertNext = False
-        return False
-    elif command == '1':
-        # File reference
-        if readLater is None:
-            lineType1(line, o, material, BFCContext(bfc, True), subfiles=subfiles, merge=merge)
-        else:
-            newbfc = BFCContext(bfc, True)
-            readLater.append((line, o, material, newbfc, subfiles, merge))
-        bfc.invertNext = False
-        return True
-    elif command in ('3', '4'):
-        # Tri or quad (poly)
-        line = line.split()
+def instanceCollection(fname, material, bfc, subfiles, merge):
+    # Each file is built once per inherited color, into a collection of its
+    # own that every placement then instances
+    global COLLECTION
+    key = (fname, material)
+    if key not in INSTANCECOLLECTIONS:
+        name = os.path.split(fname.replace('\\', os.path.sep))[1]
+        coll = bpy.data.collections.new("{0} {1}".format(name, "16" if material is None else material.name))
+        outer = COLLECTION
+        COLLECTION = coll
         try:
-            newFace = poly(line[2:], bm, bfc)
-        except ValueError as e:
-            warnings.warn(e)
-            bfc.invertNext = False
-            return True # for debugging, maybe?
-        color, faceMat = colorReference(line[1])
-        if color not in (16, 24):
-            slotIdx = -1
-            for i, matSlot in enumerate(o.material_slots):
-                if matSlot.material == faceMat and matSlot.link == "DATA":
-                    slotIdx = i
-                    break
-            if slotIdx == -1:
-                o.data.materials.append(faceMat)
-                newFace.material_index = len(o.material_slots)-1
+            if fname in subfiles:
+                obj = readFile(fname, BFCContext(bfc), subfiles=subfiles, material=material, merge=merge)
             else:
-                newFace.material_index = slotIdx
+                obj = readFile(fname, BFCContext(bfc), material=material, merge=merge or (MERGEPARTS and isAPart(fname)))
+        finally:
+            COLLECTION = outer
+        if obj is None:
+            bpy.data.collections.remove(coll)
+            coll = None
         else:
-            newFace.material_index = 0
-        bfc.invertNext = False
-        return True
-    elif command == '2':
-        # Line
-        line = line.split()
-        verts = [findVert(bm, mathutils.Vector((float(line[2]), float(line[3]), float(line[4])))),
-                 findVert(bm, mathutils.Vector((float(line[5]), float(line[6]), float(line[7]))))]
-        newEdge = bm.edges.get(verts, None)
-        if newEdge is None: newEdge = bm.edges.new(verts)
-        newEdge.smooth = False
-        bfc.invertNext = False
-        return True
-    elif command == '5':
-        # Conditional line
-        # Not supported
-        bfc.invertNext = False
-        return False
-    else:
-        warnings.warn("Unknown linetype %s\n" % command)
-        return False
+            coll.objects.link(obj)
+        INSTANCECOLLECTIONS[key] = coll
+    return INSTANCECOLLECTIONS[key]
+
+def loadModel(fname, path):
+    # Multi-part files are indexed once per import, even if the pre-scan for
+    # worker processes has already read them, and their sections are only
+    # parsed when first referenced
+    if path not in MODELS:
+        model = ldrawcore.MPDFile.open(path, fname, WELDTHRESHOLD)
+        MODELS[path] = model.firstName, model
+    return MODELS[path]
+
+def cacheOptions():
+    return [LDRAWDIR, HIRES, LOWRES, SMOOTH, GAP, WELDTHRESHOLD, STUDLESS]
+
+def workerPython():
+    # The Python interpreter to start worker processes with. Before 2.91,
+    # sys.executable is Blender itself and the bundled Python is
+    # bpy.app.binary_path_python.
+    python = getattr(bpy.app, 'binary_path_python', None) or sys.executable
+    if not os.path.basename(python).lower().startswith('python'):
+        warnings.warn("No Python interpreter to start workers with ({0}); merging parts in Blender".format(python))
+        return None
+    return python
+
+def preflattenParts(fname):
+    # Find every part the model places and flatten them all in worker
+    # processes, leaving only mesh and object creation for later
+    path = LIBRARY.find(fname)
+    if path is None:
+        return
+    subfiles = {}
+    if os.path.splitext(fname)[1] in ('.mpd', '.ldr'):
+        fname, subfiles = loadModel(fname, path)
+
+    def load(name):
+        if name in subfiles:
+            return subfiles[name], None
+        return LIBRARY.load(name.replace('\\', os.path.sep))
 
-def readFile(fname, bfc, first=False, smooth=False, material=None, transform=False, subfiles={}, merge=False):
+    def isMerged(name):
+        return name not in subfiles and name != 'light.dat' and isAPart(name)
+
+    names = set()
+    for name in ldrawcore.scanParts(fname, load, isMerged):
+        name = name.replace('\\', os.path.sep)
+        flat = None if PARTCACHE is None else PARTCACHE.get(name, cacheOptions())
+        if flat is None:
+            names.add(name)
+        else:
+            ldrawcore.PROFILE.count(name, 'cacheHits')
+            FLATTENED[name] = flat
+    python = workerPython() if WORKERS > 1 else None
+    if python is None:
+        # Built here instead, still going into the part cache
+        for name in names:
+            FLATTENED[name] = flattenFile(name, {})
+        return
+    with ldrawcore.PROFILE.phase('merging'):
+        flattened = ldrawcore.flattenParts(names, LDRAWDIR, HIRES, LOWRES, WELDTHRESHOLD,
+                                           SMOOTH, GAP, WORKERS, python, LIBRARY.index, STUDLESS)
+    for name, flat in flattened.items():
+        FLATTENED[name] = flat
+        if flat is not None and PARTCACHE is not None and None not in flat.deps:
+            PARTCACHE.put(name, cacheOptions(), flat)
+
+def flattenFile(fname, subfiles):
+    # Merged parts come from the part cache when every file involved is
+    # from the library
+    if fname in FLATTENED:
+        return FLATTENED[fname]
+    options = cacheOptions()
+    if fname not in subfiles and PARTCACHE is not None:
+        flat = PARTCACHE.get(fname, options)
+        if flat is not None:
+            ldrawcore.PROFILE.count(fname, 'cacheHits')
+            return flat
+
+    def load(name):
+        if name in subfiles:
+            return subfiles[name], None
+        return LIBRARY.load(name)
+
+    flat = ldrawcore.flatten(fname, load, isAPart, SMOOTH, GAP, FLATTENED, STUDLESS)
+    if flat is not None and PARTCACHE is not None and None not in flat.deps:
+        PARTCACHE.put(fname, options, flat)
+    return flat
+
+@ldrawcore.profiled('meshes')
+def buildMesh(geom, o, mesh, cull=True, invert=False):
+    # Fills an empty mesh in bulk, instead of adding elements one at a time
+    # through BMesh. Material slot 0 is left for the inherited color. Unless
+    # cull is False, faces that BFC lets be culled are marked in the
+    # CULLATTRIBUTE face attribute. invert reverses every face, for files
+    # placed under INVERTNEXT.
+    slots = materialSlots(o)
+    slotCount = len(o.material_slots)
+    slotMap = [0]
+    for color in geom.slotColors[1:]:
+        color, faceMat = colorReference(color)
+        if faceMat not in slots:
+            o.data.materials.append(faceMat)
+            slots[faceMat] = slotCount
+            slotCount += 1
+        slotMap.append(slots[faceMat])
+    slotMap = numpy.array(slotMap, dtype=numpy.int32)
+
+    mesh.vertices.add(geom.vertCount)
+    mesh.vertices.foreach_set("co", numpy.asarray(geom.verts, dtype=numpy.float32))
+
+    sizes = numpy.asarray(geom.faceSizes, dtype=numpy.int32)
+    starts = numpy.zeros(len(sizes), dtype=numpy.int32)
+    numpy.cumsum(sizes[:-1], out=starts[1:])
+    mesh.loops.add(len(geom.faceVerts))
+    faceVerts = geom.reversedFaceVerts() if invert else geom.faceVerts
+    mesh.loops.foreach_set("vertex_index", numpy.asarray(faceVerts, dtype=numpy.int32))
+    mesh.polygons.add(len(sizes))
+    mesh.polygons.foreach_set("loop_start", starts)
+    if bpy.app.version < (4, 0, 0):
+        # Read-only (derived from loop_start) from 4.0 on
+        mesh.polygons.foreach_set("loop_total", sizes)
+    flags = numpy.asarray(geom.faceFlags, dtype=numpy.uint8)
+    mesh.polygons.foreach_set("material_index", slotMap[numpy.asarray(geom.faceSlots, dtype=numpy.int32)])
+    mesh.polygons.foreach_set("use_smooth", (flags & ldrawcore.FACE_SMOOTH) != 0)
+    single = (flags & ldrawcore.FACE_CULL) != 0
+    if cull and FACEATTRIBUTES and single.any():
+        mesh.attributes.new(CULLATTRIBUTE, 'BOOLEAN', 'FACE').data.foreach_set("value", single)
+
+    # Line-type 2 records become loose edges, or mark the face edges they
+    # lie on, and are always sharp
+    edges = numpy.asarray(geom.edges, dtype=numpy.int32)
+    mesh.edges.add(len(edges)//2)
+    mesh.edges.foreach_set("vertices", edges)
+    mesh.update(calc_edges=True, calc_edges_loose=True)
+    # Conditional lines (type 5) only mark the face edges they lie on, and
+    # only those where the surface creases; the rest are smooth seams. Both
+    # together are the outline, marked for Freestyle too.
+    creases = numpy.asarray(geom.condEdges, dtype=numpy.int32).reshape(-1, 2)[geom.folds() > CREASEANGLE]
+    if len(edges) or len(creases):
+        outline = numpy.concatenate((edges.reshape(-1, 2), creases))
+        sharp = numpy.isin(edgeKeys(mesh), edgeKeys(outline, geom.vertCount))
+        mesh.edges.foreach_set("use_edge_sharp", sharp)
+        if 'use_freestyle_mark' in bpy.types.MeshEdge.bl_rna.properties:
+            mesh.edges.foreach_set("use_freestyle_mark", sharp)
+
+def faceColors(o, mesh):
+    # The color of each face's material slot as a face attribute, for
+    # exporters and shaders that read colors rather than materials. Faces
+    # in the inherited slot get the main color.
+    main = (1.0, 1.0, 1.0, 1.0)
+    if 16 in PALETTE:
+        attribs = parseColorAttributes(PALETTE[16][1])[0]
+        main = srgbToLinearrgbV3V3(hex2rgb(attribs['VALUE']))+(1.0,)
+    colors = numpy.array([main if slot.material is None else tuple(slot.material.diffuse_color)
+                          for slot in o.material_slots] or [main], dtype=numpy.float32)
+    slots = numpy.zeros(len(mesh.polygons), dtype=numpy.int32)
+    mesh.polygons.foreach_get("material_index", slots)
+    attribute = mesh.attributes.new("Color", 'FLOAT_COLOR', 'FACE')
+    attribute.data.foreach_set("color", colors[slots].ravel())
+
+def edgeKeys(edges, vertCount=None):
+    # One int64 per edge, independent of the order of its vertices
+    if vertCount is None:
+        mesh = edges
+        vertCount = len(mesh.vertices)
+        edges = numpy.empty(len(mesh.edges)*2, dtype=numpy.int32)
+        mesh.edges.foreach_get("vertices", edges)
+        edges = edges.reshape(-1, 2)
+    edges = numpy.sort(edges.astype(numpy.int64), axis=1)
+    return edges[:, 0]*vertCount + edges[:, 1]
+
+def readFile(fname, bfc, first=False, smooth=False, material=None, transform=False, subfiles={}, merge=False, later=None):
     global IGNOREOBJECTS
     if fname in subfiles:
         # part of a multi-part
-        import io
-        f = io.StringIO(subfiles[fname])
+        path = None
     else:
         fname = fname.replace('\\', os.path.sep)
-        f = None
-
-        paths = [fname,
-                 os.path.join(LDRAWDIR, "parts", fname),
-                 os.path.join(LDRAWDIR, "p", fname),
-                 os.path.join(LDRAWDIR, "models", fname)]
-        if HIRES:
-            paths.insert(2, os.path.join(LDRAWDIR, "p", "48", fname))
-        if LOWRES:
-            paths.insert(2, os.path.join(LDRAWDIR, "p", "8", fname))
-
-        for path in paths:
-            if os.path.exists(path):
-                f = open(path)
-                break
+        path = LIBRARY.find(fname)
 
-        if f is None:
+        if path is None:
             warnings.warn("Could not find file %s" % fname)
             return
 
         if os.path.splitext(fname)[1] in ('.mpd', '.ldr'):
             # multi-part!
-            subfiles = {}
-            name = None
-            firstName = None
-            for line in f:
-                if line[0] == '0':
-                    sline = line.split()
-                    if len(sline) < 2:
-                        continue
-                    if sline[1] == 'FILE':
-                        i = line.find('FILE')
-                        i += 4
-                        name = line[i:].strip().lower()
-                        subfiles[name] = ''
-                        if firstName is None:
-                            firstName = name
-                    elif sline[1] == 'NOFILE':
-                        name = None
-                    elif name is not None:
-                        subfiles[name] += line
-                elif name is not None:
-                    subfiles[name] += line
-            if firstName is None:
-                # This is if it wasn't actually multi-part (as is the case with most LDRs)
-                firstName = fname.lower()
-                f.seek(0)
-                subfiles[firstName] = f.read()
-            f.close()
-            # "When an MPD file is used to store a multi-file model, the first
-            # file in the MPD is treated as the 'main model'"
-            return readFile(firstName, bfc, first=first, smooth=smooth, material=material, transform=transform, subfiles=subfiles, merge=merge)
+            firstName, subfiles = loadModel(fname, path)
+            return readFile(firstName, bfc, first=first, smooth=smooth, material=material, transform=transform, subfiles=subfiles, merge=merge, later=later)
 
     mname = os.path.split(fname)[1]
     if mname in IGNOREOBJECTS:
         return None
-    if mname in bpy.data.objects:
+    if isAPart(fname) and not ldrawcore.isSubpart(fname):
+        # Whether a part can be culled, and which way its faces point, doesn't
+        # depend on the model placing it, which is rarely certified
+        bfc.accumCull = True
+        bfc.accumInvert = False
+    # A file placed under a different BFC state is built differently
+    variant = (mname, bfc.accumCull, bfc.accumInvert)
+    template = TEMPLATES.get(variant)
+    if template is None and mname not in STALE and variant[1:] == (True, False):
+        template = bpy.data.objects.get(mname)
+        if template is not None and template.type == 'MESH' and template.data.ldrawPart:
+            # Only a part built the same way, and not a stand-in
+            part = json.loads(template.data.ldrawPart)
+            if part.get('proxy') or part['options'] != partOptions():
+                template = None
+    if template is not None:
         # We don't need to re-import a part if it's already in the file
-        obj = copyAndApplyMaterial(bpy.data.objects[mname], material)
+        obj = copyAndApplyMaterial(template, material)
         obj.active_material_index = 0
         obj.active_material = material
         obj.material_slots[0].link = 'OBJECT'
         obj.active_material = material
         return obj
 
-    mesh = bpy.data.meshes.new(mname)
-    bm = bmesh.new()
+    started = time.perf_counter()
+    if merge:
+        # Every reference is inlined, so there is nothing left to recurse into
+        parsed = None
+        geom = flattenFile(fname, subfiles)
+        if geom is None:
+            return None
+    else:
+        if path is None:
+            parsed = subfiles[fname]
+        else:
+            parsed = LIBRARY.load(fname)[0]
+        geom = ldrawcore.FlatMesh.fromFile(parsed)
+
+    defineColours(geom.colours)
+    if geom.certified is not None:
+        bfc.certified = geom.certified
+
+    if not geom.hasData:
+        # This is to check for header files (like ldconfig.ldr) and
+        # other blank files (like 4-4edge.dat)
+        IGNOREOBJECTS.add(mname)
+        return None
+
+    # Identical geometry shares one mesh, whatever file it came from (alias
+    # parts, moved parts, other colors of a pattern)
+    tagged = merge and isAPart(fname)
+    digest = geom.digest(json.dumps([[PALETTE.get(int(c)) for c in geom.slotColors[1:]],
+                                     partOptions() if tagged else None, first and BAKE, bfc.accumCull, bfc.accumInvert,
+                                     SMOOTH and ldrawcore.isRoundPrimitive(fname), SMOOTH and isAPart(fname)]))
+    mesh = MESHES.get(digest)
+    shared = mesh is not None
+    if not shared:
+        mesh = bpy.data.meshes.new(mname)
     obj = bpy.data.objects.new(mname, mesh)
+    TEMPLATES[variant] = obj
 
     obj.active_material_index = 0
     obj.active_material = material
     obj.material_slots[0].link = 'OBJECT'
     obj.active_material = material
+    if first and transform:
+        obj.matrix_local = DEFAULTMAT
 
-    containsData = False
-    if first:
-        lines = f.readlines()
-        f.close()
-        total = len(lines)
-        readLaterLines = [None]*total
-        for idx, line in enumerate(lines):
-            readLater = []
-            containsData = readLine(line, obj, material, bfc, bm, subfiles=subfiles, readLater=readLater, merge=merge) or containsData
-            readLaterLines[idx] = readLater
-        if transform:
-            obj.matrix_local = DEFAULTMAT
-        del lines
+    if shared:
+        ldrawcore.PROFILE.count(mname, 'sharedMeshes')
     else:
-        readLater = []
-        for line in f:
-            containsData = readLine(line, obj, material, bfc, bm, subfiles=subfiles, readLater=readLater, merge=merge) or containsData
-        f.close()
-
-    if SMOOTH and (
-        (('con' in fname) and
-         (not fname.startswith('con'))) or
-        ('cyl' in fname) or
-        ('sph' in fname) or
-        fname.startswith('t0') or
-        fname.startswith('t1') or
-        ('bump' in fname)):
-
-        setMeshSmooth(bm)
-
-        # Old method - the loop is probably faster (being written in C), but it
-        # causes a scene update after
-        #bpy.ops.object.shade_smooth()
-
-    if SMOOTH and isAPart(fname):
-        setMeshSmooth(bm)
-        mesh.use_auto_smooth = True
-        mesh.auto_smooth_angle = math.pi
-    
-    bm.to_mesh(mesh)
-    bm.free()
-
-    if first:
-        bpy.context.window_manager.progress_begin(0, total)
-        for idx, readLater in enumerate(readLaterLines):
-            for args in readLater:
-                print("Processing line {0}/{1}".format(idx+1, total))
-                lineType1(*args)
-                bpy.context.window_manager.progress_update(idx+1)
-        bpy.context.window_manager.progress_end()
+        buildMesh(geom, obj, mesh, cull=bfc.accumCull, invert=bfc.accumInvert)
+        mesh.ldrawHash = digest
+        MESHES[digest] = mesh
+        if first and BAKE and FACEATTRIBUTES:
+            faceColors(obj, mesh)
+        if tagged:
+            mesh.ldrawPart = json.dumps({'file': fname, 'options': partOptions()})
+
+        if SMOOTH and ldrawcore.isRoundPrimitive(fname):
+
+            setMeshSmooth(mesh)
+
+            # Old method - the loop is probably faster (being written in C), but it
+            # causes a scene update after
+            #bpy.ops.object.shade_smooth()
+
+        if SMOOTH and isAPart(fname):
+            setMeshSmooth(mesh)
+            mesh.use_auto_smooth = True
+            mesh.auto_smooth_angle = math.pi
+
+    ldrawcore.PROFILE.count(mname, 'verts', geom.vertCount)
+    ldrawcore.PROFILE.count(mname, 'faces', geom.faceCount)
+    # Only the file's own cost; its references are counted on their own
+    ldrawcore.PROFILE.count(mname, 'seconds', time.perf_counter()-started)
+
+    total = 0 if parsed is None else parsed.refCount
+    if later is not None:
+        # Left for the caller to work through a few at a time
+        later.extend((parsed, idx, obj, material, bfc, subfiles, merge) for idx in range(total))
     else:
-        for args in readLater:
-            lineType1(*args)
+        for idx in range(total):
+            lineType1(parsed, idx, obj, material, BFCContext(bfc, True), subfiles=subfiles, merge=merge)
     
     #bm = bmesh.new()
     #bm.from_mesh(mesh)
@@ -707,25 +805,456 @@ def readFile(fname, bfc, first=False, smooth=False, material=None, transform=Fal
     #bm.to_mesh(mesh)
     #bm.free()
     mesh.update()
-    
-    if not containsData:
-        # This is to check for header files (like ldconfig.ldr) and
-        # other blank files (like 4-4edge.dat)
-        IGNOREOBJECTS.add(mname)
-        bpy.data.objects.remove(obj)
+    return obj
+
+### PROXIES ###
+
+BOXFACES = ((0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3))
+
+def partOptions():
+    # Everything that goes into a merged part's geometry and materials
+    return {'LDRAWDIR': LDRAWDIR, 'HIRES': HIRES, 'LOWRES': LOWRES, 'STUDLESS': STUDLESS,
+            'SMOOTH': SMOOTH, 'GAP': GAP, 'WELDTHRESHOLD': WELDTHRESHOLD, 'USECACHE': USECACHE,
+            'NODEMATERIALS': NODEMATERIALS}
+
+def partBounds(fname):
+    # Only the cache entry's header is read when the part has been merged
+    # before
+    if PARTCACHE is not None:
+        bounds = PARTCACHE.bounds(fname, cacheOptions())
+        if bounds is not None:
+            ldrawcore.PROFILE.count(fname, 'cacheHits')
+            return bounds
+    flat = flattenFile(fname, {})
+    return None if flat is None else flat.bounds()
+
+def proxyObject(fname, material):
+    """
+    A stand-in for a part: its bounding box, in its color. The box is shared
+    by every copy of the part, and remembers what to build in its place (see
+    loadProxies).
+    """
+    fname = fname.replace('\\', os.path.sep)
+    mname = os.path.split(fname)[1]
+    if fname not in PROXYMESHES:
+        bounds = partBounds(fname)
+        mesh = None
+        if bounds is not None:
+            (x0, y0, z0), (x1, y1, z1) = bounds
+            mesh = bpy.data.meshes.new(mname)
+            mesh.from_pydata([(x, y, z) for x in (x0, x1) for y in (y0, y1) for z in (z0, z1)], [], BOXFACES)
+            mesh.ldrawPart = json.dumps({'file': fname, 'options': partOptions(), 'proxy': True})
+        PROXYMESHES[fname] = mesh
+    if PROXYMESHES[fname] is None:
         return None
+    obj = bpy.data.objects.new(mname, PROXYMESHES[fname])
+    obj.active_material_index = 0
+    obj.active_material = material
+    obj.material_slots[0].link = 'OBJECT'
+    obj.active_material = material
     return obj
 
-def main(fname, context=None, transform=False):
-    global MATERIALS, IGNOREOBJECTS
-    start = time.time()
+def swapMesh(obj, mesh):
+    # Keeps the object's own color in slot 0
+    material = obj.material_slots[0].material if len(obj.material_slots) else None
+    obj.data = mesh
+    obj.active_material_index = 0
+    obj.active_material = material
+    obj.material_slots[0].link = 'OBJECT'
+    obj.active_material = material
+
+def setPartMeshes(context, targets):
+    """
+    Give each object of targets, a list of (object, part file, partOptions),
+    that part's geometry as built with those options. Each part is built
+    once per set of options, and the mesh is shared; meshes already built
+    are found by their ldrawPart tags. Returns the number of objects changed.
+    """
+    global LDRAWDIR, HIRES, LOWRES, STUDLESS, SMOOTH, GAP, GAPMAT, WELDTHRESHOLD, USECACHE, NODEMATERIALS, STALE
+    if IMPORTING:
+        # beginImport would reset the state the running import is using
+        return 0
+    built = {}
+    for mesh in bpy.data.meshes:
+        if mesh.ldrawPart:
+            part = partTag(mesh)
+            if not part.get('proxy'):
+                built.setdefault((part['file'], json.dumps(part['options'], sort_keys=True)), mesh)
+    groups = {}
+    for obj, fname, options in targets:
+        groups.setdefault(json.dumps(options, sort_keys=True), {}).setdefault(fname, []).append(obj)
+    count = 0
+    for key, parts in groups.items():
+        missing = [fname for fname in parts if (fname, key) not in built]
+        if missing:
+            options = json.loads(key)
+            LDRAWDIR, HIRES, LOWRES, STUDLESS = options['LDRAWDIR'], options['HIRES'], options['LOWRES'], options['STUDLESS']
+            SMOOTH, GAP, WELDTHRESHOLD = options['SMOOTH'], options['GAP'], options['WELDTHRESHOLD']
+            USECACHE = options['USECACHE']
+            # Tags from before node materials were recorded
+            NODEMATERIALS = options.get('NODEMATERIALS', False)
+            GAPMAT = mathutils.Matrix.Scale(1.0-GAP, 4)
+            beginImport(context)
+            # Objects carrying the parts' names may be built differently, so
+            # they must not be copied
+            STALE = set(os.path.split(fname)[1] for fname in missing)
+            for fname in missing:
+                part = readFile(fname, BFCContext(), merge=True)
+                if part is None:
+                    continue
+                built[(fname, key)] = part.data
+                for variant in [variant for variant, obj in TEMPLATES.items() if obj == part]:
+                    del TEMPLATES[variant]
+                bpy.data.objects.remove(part)
+        for fname, objs in parts.items():
+            mesh = built.get((fname, key))
+            if mesh is None:
+                continue
+            for obj in objs:
+                if obj.data != mesh:
+                    swapMesh(obj, mesh)
+                    count += 1
+    return count
+
+# Parsed ldrawPart tags by their text, as detail changes read every one on
+# every frame
+PARTTAGS = {}
+RENDERING = False
+
+def partTag(mesh):
+    tag = mesh.ldrawPart
+    if tag not in PARTTAGS:
+        PARTTAGS[tag] = json.loads(tag)
+    return PARTTAGS[tag]
+
+def partFile(obj, part):
+    # The part an object places. Identical parts share one mesh, whose tag
+    # only names the first of them.
+    return obj.ldrawFile.replace('\\', os.path.sep) if obj.ldrawFile else part['file']
+
+def loadProxies(context, objects):
+    # Real geometry for every proxy among objects, built the way it would
+    # have been at import
+    targets = []
+    for obj in objects:
+        if obj.type == 'MESH' and obj.data.ldrawPart:
+            part = partTag(obj.data)
+            if part.get('proxy'):
+                targets.append((obj, partFile(obj, part), part['options']))
+    return setPartMeshes(context, targets)
+
+### LEVELS OF DETAIL ###
+
+# From nearest to farthest
+DETAILS = ('HIGH', 'NORMAL', 'LOW', 'STUDLESS')
+
+def detailOptions(options, detail):
+    """
+    >>> sorted(detailOptions({'HIRES': True, 'GAP': 0.0}, 'STUDLESS').items())
+    [('GAP', 0.0), ('HIRES', False), ('LOWRES', True), ('STUDLESS', True)]
+    """
+    return dict(options, HIRES=(detail == 'HIGH'), LOWRES=(detail in ('LOW', 'STUDLESS')),
+                STUDLESS=(detail == 'STUDLESS'))
+
+def applyDetail(context, scene):
+    """
+    Switch every merged part in the scene to the level of detail picked by
+    scene.ldrawDetail, building levels the first time they are needed.
+    Proxies stay proxies until their geometry is loaded. With 'DISTANCE',
+    each object's level comes from its distance to the scene camera and
+    scene.ldrawDetailDistances.
+    """
+    camera = scene.camera
+    targets = []
+    for obj in scene.objects:
+        if obj.type != 'MESH' or not obj.data.ldrawPart:
+            continue
+        part = partTag(obj.data)
+        if part.get('proxy'):
+            continue
+        detail = scene.ldrawDetail
+        if detail == 'DISTANCE':
+            if camera is None:
+                detail = 'NORMAL'
+            else:
+                distance = (obj.matrix_world.translation - camera.matrix_world.translation).length
+                detail = DETAILS[bisect.bisect(list(scene.ldrawDetailDistances), distance)]
+        targets.append((obj, partFile(obj, part), detailOptions(part['options'], detail)))
+    return setPartMeshes(context, targets)
+
+def updateDetail(self, context):
+    applyDetail(context, self)
+
+@bpy.app.handlers.persistent
+def detailFrameChange(scene, depsgraph=None):
+    # The camera or the parts may move during an animation. Meshes may only
+    # be swapped during a render if it locks the interface.
+    if scene.ldrawDetail == 'DISTANCE' and not IMPORTING and (not RENDERING or scene.render.use_lock_interface):
+        applyDetail(bpy.context, scene)
+
+@bpy.app.handlers.persistent
+def renderStarted(scene, depsgraph=None):
+    global RENDERING
+    RENDERING = True
+
+@bpy.app.handlers.persistent
+def renderEnded(scene, depsgraph=None):
+    global RENDERING
+    RENDERING = False
+
+### RE-IMPORT ###
+
+def importOptions():
+    # Anything that changes how a model is put together, rather than just
+    # which files go into it
+    return cacheOptions() + [MERGEPARTS, INSTANCES, USELIGHTS, PROXIES, BAKE]
+
+def modelManifest(fname):
+    """
+    What a model was imported from: a hash of every MPD section (covering
+    what it references) and the stamp of every library file the sections
+    reference, which covers the files that one references in turn. Kept as
+    JSON on the root object.
+    """
+    path = LIBRARY.find(fname)
+    if path is None or os.path.splitext(fname)[1] not in ('.mpd', '.ldr'):
+        return None
+    firstName, model = loadModel(fname, path)
+    files = {}
+
+    def stamp(name):
+        if name not in files:
+            deps = libraryStamps(name.replace('\\', os.path.sep))
+            files[name] = None if deps is None else hashlib.sha1(json.dumps(deps).encode()).hexdigest()
+        return files[name]
+
+    return {'path': os.path.abspath(path), 'options': importOptions(), 'first': firstName,
+            'sections': ldrawcore.sectionHashes(model, stamp), 'files': files}
+
+def libraryStamps(fname):
+    """
+    Sorted [path, stamp] pairs of a library file and every file below it,
+    or None if it can't be found. Merged parts take them from the part
+    cache's header, when it has a valid entry.
+    """
+    if LIBRARY.find(fname) is None:
+        return None
+    if MERGEPARTS and PARTCACHE is not None and isAPart(fname):
+        deps = PARTCACHE.deps(fname, cacheOptions())
+        if deps is not None:
+            return deps
+    stamps = {}
+
+    def visit(name):
+        path = LIBRARY.find(name)
+        if (path or name) in stamps:
+            return
+        stamps[path or name] = None if path is None else ldrawcore.fileStamp(path)
+        if path is not None:
+            for child in set(LIBRARY.load(name)[0].refNames):
+                visit(child.replace('\\', os.path.sep))
+
+    visit(fname)
+    return [[path, stamps[path]] for path in sorted(stamps)]
+
+def findImported(scene, manifest):
+    for obj in scene.objects:
+        if obj.parent is None and obj.ldrawManifest:
+            old = json.loads(obj.ldrawManifest)
+            if old['path'] == manifest['path']:
+                return obj, old
+    return None, None
+
+def objectTree(o):
+    yield o
+    for c in o.children:
+        yield from objectTree(c)
+
+def removeObject(o):
+    for c in o.children:
+        removeObject(c)
+    bpy.data.objects.remove(o)
+
+def applyMaterial(o, mat):
+    # In-place counterpart of copyAndApplyMaterial
+    if o.type != 'MESH':
+        return
+    if len(o.material_slots) > 0:
+        o.material_slots[0].material = mat
+    elif mat is not None:
+        o.active_material_index = 0
+        o.active_material = mat
+        o.material_slots[0].link = 'OBJECT'
+        o.active_material = mat
+    for c in o.children:
+        if c.ldrawInheritsColor:
+            applyMaterial(c, mat)
+
+def updateModel(root, fname, manifest, old, transform):
+    """
+    Bring a model imported earlier up to date. Only submodels whose hash
+    changed are revisited; their references are matched to the existing
+    children placing the same file, which are moved and recolored in
+    place, and children left over are removed. Parts whose files changed
+    are built again.
+    """
+    changed = {name for name, h in manifest['sections'].items() if old['sections'].get(name) != h}
+    stale = {name for name, stamp in manifest['files'].items() if old['files'].get(name, stamp) != stamp}
+    STALE.update(os.path.basename(name.replace('\\', os.path.sep)) for name in changed | stale)
+    firstName, model = loadModel(fname, LIBRARY.find(fname))
+    for name in model:
+        defineColours(model[name].colours)
+    updateObject(root, firstName, model, changed, stale, None, BFCContext(), {})
+    root.matrix_local = DEFAULTMAT if transform else mathutils.Matrix.Identity(4)
+    root.ldrawManifest = json.dumps(manifest)
+
+def updateObject(obj, fname, subfiles, changed, stale, material, bfc, meshes):
+    if fname not in changed:
+        return
+    mname = os.path.split(fname)[1]
+    parsed = subfiles[fname]
+    geom = ldrawcore.FlatMesh.fromFile(parsed)
+    if geom.certified is not None:
+        bfc.certified = geom.certified
+    # The section's own faces are rebuilt once, and shared by every copy
+    if fname not in meshes:
+        mesh = bpy.data.meshes.new(mname)
+        obj.data = mesh
+        obj.active_material_index = 0
+        obj.active_material = material
+        obj.material_slots[0].link = 'OBJECT'
+        obj.active_material = material
+        buildMesh(geom, obj, mesh)
+        meshes[fname] = mesh
+    else:
+        obj.data = meshes[fname]
+        applyMaterial(obj, material)
+
+    children = {}
+    for c in obj.children:
+        children.setdefault(c.ldrawFile, []).append(c)
+    for idx in range(parsed.refCount):
+        child = parsed.refNames[idx]
+        if child in stale or not children.get(child):
+            lineType1(parsed, idx, obj, material, BFCContext(bfc, True), subfiles=subfiles)
+            continue
+        c = children[child].pop()
+        materialId, childMaterial = referenceMaterial(parsed, idx, material)
+        c.matrix_local = referenceMatrix(parsed, idx)
+        c.ldrawInheritsColor = materialId in (16, 24)
+        applyMaterial(c, childMaterial)
+        if child in subfiles:
+            updateObject(c, child, subfiles, changed, stale, childMaterial, BFCContext(bfc, True), meshes)
+    for leftover in children.values():
+        for c in leftover:
+            removeObject(c)
+
+def beginImport(context):
+    # Fresh per-import state, and the colors of LDConfig.ldr
+    global PALETTE, MATERIALS, IGNOREOBJECTS, LIBRARY, FLATTENED, PARTCACHE, MODELS, COLLECTION, INSTANCECOLLECTIONS, TEMPLATES, STALE, PROXYMESHES, MESHES
     MATERIALS = {}
     IGNOREOBJECTS = set()
-    readFile(os.path.join(LDRAWDIR, "LDConfig.ldr"), BFCContext(), first=False)
-    obj = readFile(fname, BFCContext(), first=True, transform=transform, merge=(MERGEPARTS and isAPart(fname)))
-    bpy.context.scene.collection.objects.link(obj)
-    context.view_layer.update()
+    # Members of a zipped library are kept decompressed between imports
+    ldrawcore.ARCHIVECACHE = ARCHIVECACHE if USECACHE else 0
+    LIBRARY = ldrawcore.Library(LDRAWDIR, HIRES, LOWRES, WELDTHRESHOLD,
+                                ldrawcore.LibraryIndex(LDRAWDIR, persist=USECACHE))
+    FLATTENED = {}
+    PARTCACHE = ldrawcore.PartCache(find=LIBRARY.find) if USECACHE else None
+    MODELS = {}
+    COLLECTION = context.scene.collection
+    INSTANCECOLLECTIONS = {}
+    TEMPLATES = {}
+    STALE = set()
+    PROXYMESHES = {}
+    # Meshes from earlier imports into this file are shared too
+    MESHES = {mesh.ldrawHash: mesh for mesh in bpy.data.meshes if mesh.ldrawHash}
+    try:
+        PALETTE = dict(ldrawcore.loadPalette(LIBRARY.index.config or os.path.join(LDRAWDIR, "LDConfig.ldr")))
+    except OSError:
+        warnings.warn("Could not find file LDConfig.ldr")
+        PALETTE = {}
+
+def endImport():
+    # The model files are memory-mapped; nothing may keep them open once the
+    # import is over
+    global MODELS
+    for firstName, model in MODELS.values():
+        model.close()
+    MODELS = {}
+
+def importSteps(fname, context, transform=False):
+    """
+    The import as a generator, which yields (done, total) after each
+    reference of the top-level file, so it can be run a slice at a time.
+    The top-level object is linked first, and its children show up as they
+    are made.
+    """
+    start = time.time()
+    viewLayer = context.view_layer
+    ldrawcore.PROFILE = ldrawcore.Profile(enabled=bool(PROFILEPATH))
+    beginImport(context)
+    try:
+        # A part picked by its path is still a part, to be merged and tagged
+        fname = LIBRARY.index.partName(fname) or fname
+        # Only imports made to be updated later carry a manifest
+        manifest = modelManifest(fname) if INCREMENTAL else None
+        root = old = replaced = None
+        if INCREMENTAL and manifest is not None:
+            root, old = findImported(context.scene, manifest)
+            if root is not None and (INSTANCES or BAKE or old['options'] != manifest['options'] or old['first'] != manifest['first']):
+                # Built differently, or baked into instanced collections or a
+                # single mesh; start over. The old import is only removed
+                # once the new one is done, so cancelling keeps it, and
+                # nothing is copied from it meanwhile.
+                replaced = root
+                STALE.update(o.name for o in objectTree(root))
+                root = None
+        if root is not None:
+            updateModel(root, fname, manifest, old, transform)
+        else:
+            if (MERGEPARTS and WORKERS > 1) or BAKE:
+                preflattenParts(fname)
+            later = []
+            # Baking inlines the whole model, submodels and all, like a part
+            obj = readFile(fname, BFCContext(), first=True, transform=transform, merge=(BAKE or (MERGEPARTS and isAPart(fname))), later=later)
+            COLLECTION.objects.link(obj)
+            if manifest is not None:
+                obj.ldrawManifest = json.dumps(manifest)
+            for done, (parsed, idx, parent, material, bfc, subfiles, merge) in enumerate(later):
+                lineType1(parsed, idx, parent, material, BFCContext(bfc, True), subfiles=subfiles, merge=merge)
+                yield done+1, len(later)
+            if replaced is not None:
+                removeObject(replaced)
+    finally:
+        endImport()
+    viewLayer.update()
     print('LDraw "{0}" imported in {1:.4} seconds.'.format(fname, time.time()-start))
+    if PROFILEPATH:
+        report = ldrawcore.PROFILE.report()
+        report['model'] = fname
+        with open(bpy.path.abspath(PROFILEPATH), 'w') as f:
+            json.dump(report, f, indent=1)
+        print(ldrawcore.PROFILE.summary())
+
+def main(fname, context=None, transform=False):
+    for step in importSteps(fname, context, transform):
+        pass
+
+# Seconds of import work between UI updates
+SLICE = 0.1
+# Set while an import runs a slice at a time, as nothing else may touch the
+# per-import state until it is done
+IMPORTING = False
+IMPORTDATA = ('objects', 'meshes', 'materials', 'collections', 'lights')
+
+def dataSnapshot():
+    return {name: set(getattr(bpy.data, name)) for name in IMPORTDATA}
+
+def rollback(snapshot):
+    # Removes whatever was added since the snapshot. Data an update changed
+    # in place stays changed.
+    added = [block for name in IMPORTDATA for block in getattr(bpy.data, name) if block not in snapshot[name]]
+    bpy.data.batch_remove(added)
 
 ### ADDON ###
 
@@ -744,7 +1273,7 @@ class ImportLdraw(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
         options={'HIDDEN'})
     ldrawPathProp: bpy.props.StringProperty(
         name="LDraw directory",
-        description="The directory in which the P and PARTS directories reside",
+        description="The directory in which the P and PARTS directories reside, or complete.zip (and zips of unofficial parts after it, separated by '{0}')".format(os.pathsep),
         maxlen=MAXPATH,
         default={"win32": "C:\\Program Files\\LDraw",
                  "darwin": "/Library/LDraw"}.get(sys.platform, "/usr/share/ldraw"))
@@ -760,6 +1289,14 @@ class ImportLdraw(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
         name="Hi-Res prims",
         description="Force use of high-resolution primitives, if possible",
         default=False)
+    lowResProp: bpy.props.BoolProperty(
+        name="Low-Res prims",
+        description="Use low-resolution primitives where available, for lighter meshes",
+        default=False)
+    studlessProp: bpy.props.BoolProperty(
+        name="No studs",
+        description="Leave studs out of merged parts",
+        default=False)
     lightProp: bpy.props.BoolProperty(
         name="Lights from model",
         description="Create lights in place of light.dat references",
@@ -775,33 +1312,248 @@ class ImportLdraw(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
         name="Merge parts",
         description="Automatically combine sub-parts into single objects",
         default=True)
+    instanceProp: bpy.props.BoolProperty(
+        name="Instance duplicates",
+        description="Build each part or submodel once per color and place it with collection instances, instead of copying objects",
+        default=False)
+    cacheProp: bpy.props.BoolProperty(
+        name="Cache parts",
+        description="Keep merged parts in an on-disk cache, so later imports skip reading the library",
+        default=True)
+    workersProp: bpy.props.IntProperty(
+        name="Worker processes",
+        description="Read and merge parts in this many background processes (0 or 1 to use only Blender's own thread)",
+        default=0,
+        min=0,
+        max=256)
+    profileProp: bpy.props.StringProperty(
+        name="Profile report",
+        description="If set, time each import phase and write a JSON report to this file",
+        maxlen=MAXPATH,
+        subtype='FILE_PATH',
+        default="")
+    nodesProp: bpy.props.BoolProperty(
+        name="Node materials",
+        description="Give materials Principled BSDF node trees for Cycles and EEVEE, copied from one template per finish",
+        default=False)
+    proxyProp: bpy.props.BoolProperty(
+        name="Part proxies",
+        description="Place each part as its bounding box, to be replaced with real geometry later (Object > Load LDraw Geometry)",
+        default=False)
+    bakeProp: bpy.props.BoolProperty(
+        name="Single mesh",
+        description="Bake the whole model into one mesh, with a material slot and a face color per color, e.g. for export",
+        default=False)
+    updateProp: bpy.props.BoolProperty(
+        name="Update existing",
+        description="If this file was imported into the scene before, rebuild only the submodels and parts that changed since",
+        default=False)
+    weldProp: bpy.props.FloatProperty(
+        name="Weld distance",
+        description="Vertices closer than this (in LDraw units) are merged into one",
+        default=THRESHOLD,
+        min=0.0,
+        max=1.0,
+        precision=5)
+    responsiveProp: bpy.props.BoolProperty(
+        name="Keep UI responsive",
+        description="Import a slice at a time, with progress shown and Esc to cancel, instead of blocking Blender until done",
+        default=True)
+    browseProp: bpy.props.BoolProperty(
+        options={'HIDDEN', 'SKIP_SAVE'},
+        default=False)
+
+    def invoke(self, context, event):
+        # Only imports picked in the file browser run a slice at a time;
+        # scripts get the finished import back from the call
+        self.browseProp = True
+        return super().invoke(context, event)
 
     def execute(self, context):
-        global LDRAWDIR, SMOOTH, HIRES, USELIGHTS, GAPMAT, MERGEPARTS
+        global LDRAWDIR, SMOOTH, HIRES, LOWRES, STUDLESS, USELIGHTS, GAP, GAPMAT, MERGEPARTS, INSTANCES, USECACHE, WORKERS, WELDTHRESHOLD, PROFILEPATH, INCREMENTAL, PROXIES, NODEMATERIALS, BAKE, IMPORTING
+        if IMPORTING:
+            self.report({'ERROR'}, "Another LDraw import is still running")
+            return {'CANCELLED'}
         LDRAWDIR = str(self.ldrawPathProp)
         transform = bool(self.transformProp)
         SMOOTH = bool(self.smoothProp)
         HIRES = bool(self.hiResProp)
+        LOWRES = bool(self.lowResProp)
+        STUDLESS = bool(self.studlessProp)
         USELIGHTS = bool(self.lightProp)
-        gap = float(self.scaleProp)
-        GAPMAT = mathutils.Matrix.Scale(1.0-gap, 4)
+        GAP = float(self.scaleProp)
+        GAPMAT = mathutils.Matrix.Scale(1.0-GAP, 4)
         MERGEPARTS = bool(self.mergePartsProp)
-        main(self.filepath, context, transform)
+        INSTANCES = bool(self.instanceProp)
+        USECACHE = bool(self.cacheProp)
+        WORKERS = int(self.workersProp)
+        WELDTHRESHOLD = float(self.weldProp)
+        PROFILEPATH = str(self.profileProp)
+        INCREMENTAL = bool(self.updateProp)
+        PROXIES = bool(self.proxyProp)
+        NODEMATERIALS = bool(self.nodesProp)
+        BAKE = bool(self.bakeProp)
+        if bpy.app.background or context.window is None or not (self.responsiveProp and self.browseProp):
+            main(self.filepath, context, transform)
+            return {'FINISHED'}
+        IMPORTING = True
+        self._snapshot = dataSnapshot()
+        self._steps = importSteps(self.filepath, context, transform)
+        wm = context.window_manager
+        wm.progress_begin(0, 1)
+        self._timer = wm.event_timer_add(0.01, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC' and event.value == 'PRESS':
+            self.finish(context)
+            rollback(self._snapshot)
+            self.report({'WARNING'}, "LDraw import cancelled")
+            return {'CANCELLED'}
+        if event.type != 'TIMER' or event.timer != self._timer:
+            return {'PASS_THROUGH'}
+        deadline = time.perf_counter()+SLICE
+        done = total = 0
+        try:
+            while time.perf_counter() < deadline:
+                done, total = next(self._steps)
+        except StopIteration:
+            self.finish(context)
+            return {'FINISHED'}
+        except Exception as e:
+            self.finish(context)
+            rollback(self._snapshot)
+            traceback.print_exc()
+            self.report({'ERROR'}, "LDraw import failed: {0}".format(e))
+            return {'CANCELLED'}
+        # Once per slice, rather than once per reference
+        if total:
+            context.window_manager.progress_update(done/total)
+            context.workspace.status_text_set("Importing LDraw reference {0}/{1} (Esc to cancel)".format(done, total))
+        return {'RUNNING_MODAL'}
+
+    def cancel(self, context):
+        # Blender dropped the import without an event, e.g. when another
+        # file was loaded or the window closed
+        self.finish(context)
+        rollback(self._snapshot)
+
+    def finish(self, context):
+        global IMPORTING
+        IMPORTING = False
+        self._steps.close()
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        if context.workspace is not None:
+            context.workspace.status_text_set(None)
+
+
+class LoadLdrawGeometry(bpy.types.Operator):
+    '''Replace LDraw part proxies with real geometry Operator.'''
+    bl_idname = "object.ldraw_load_geometry"
+    bl_label = "Load LDraw Geometry"
+    bl_description = "Replace LDraw part proxies with the parts' real geometry, e.g. before rendering"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    selectedProp: bpy.props.BoolProperty(
+        name="Selected only",
+        description="Only replace the selected proxies, instead of every proxy in the scene",
+        default=True)
+
+    def execute(self, context):
+        objects = context.selected_objects if self.selectedProp else context.scene.objects
+        count = loadProxies(context, list(objects))
+        self.report({'INFO'}, "Loaded geometry for {0} objects".format(count))
+        return {'FINISHED'}
+
+class UpdateLdrawDetail(bpy.types.Operator):
+    '''Pick LDraw part levels of detail again Operator.'''
+    bl_idname = "scene.ldraw_update_detail"
+    bl_label = "Update LDraw Detail"
+    bl_description = "Switch LDraw parts to the scene's level of detail again, e.g. after moving the camera"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute(self, context):
+        count = applyDetail(context, context.scene)
+        self.report({'INFO'}, "Changed detail of {0} objects".format(count))
         return {'FINISHED'}
 
+class LdrawScenePanel(bpy.types.Panel):
+    bl_idname = "SCENE_PT_ldraw"
+    bl_label = "LDraw"
+    bl_space_type = 'PROPERTIES'
+    bl_region_type = 'WINDOW'
+    bl_context = "scene"
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(context.scene, "ldrawDetail")
+        if context.scene.ldrawDetail == 'DISTANCE':
+            layout.prop(context.scene, "ldrawDetailDistances")
+        layout.operator(UpdateLdrawDetail.bl_idname)
+        layout.operator(LoadLdrawGeometry.bl_idname).selectedProp = False
+
 
 def menu_func_import(self, context):
     self.layout.operator(ImportLdraw.bl_idname, text="LDraw Model (.dat, .mpd, .ldr)")
 
+def menu_func_object(self, context):
+    self.layout.operator(LoadLdrawGeometry.bl_idname)
+
 def register():
     bpy.utils.register_class(ImportLdraw)
+    bpy.utils.register_class(LoadLdrawGeometry)
+    bpy.utils.register_class(UpdateLdrawDetail)
+    bpy.utils.register_class(LdrawScenePanel)
     bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
+    bpy.types.VIEW3D_MT_object.append(menu_func_object)
     bpy.types.Object.ldrawInheritsColor = bpy.props.BoolProperty()
+    bpy.types.Object.ldrawFile = bpy.props.StringProperty()
+    bpy.types.Object.ldrawManifest = bpy.props.StringProperty()
+    bpy.types.Mesh.ldrawPart = bpy.props.StringProperty()
+    bpy.types.Mesh.ldrawHash = bpy.props.StringProperty()
+    bpy.types.Scene.ldrawDetail = bpy.props.EnumProperty(
+        name="Part detail",
+        description="Level of detail of imported LDraw parts",
+        items=(('HIGH', "High", "Hi-res primitives (p/48)"),
+               ('NORMAL', "Normal", "Standard primitives"),
+               ('LOW', "Low", "Low-res primitives (p/8)"),
+               ('STUDLESS', "Low, no studs", "Low-res primitives, without studs"),
+               ('DISTANCE', "By camera distance", "Each part's level depends on its distance to the scene camera")),
+        default='NORMAL',
+        update=updateDetail)
+    bpy.types.Scene.ldrawDetailDistances = bpy.props.FloatVectorProperty(
+        name="Distances",
+        description="Camera distances beyond which parts drop to normal, low and stud-less detail",
+        size=3,
+        default=(1.0, 5.0, 20.0),
+        min=0.0,
+        subtype='DISTANCE')
+    bpy.app.handlers.frame_change_pre.append(detailFrameChange)
+    bpy.app.handlers.render_init.append(renderStarted)
+    bpy.app.handlers.render_complete.append(renderEnded)
+    bpy.app.handlers.render_cancel.append(renderEnded)
 
 def unregister():
     bpy.utils.unregister_class(ImportLdraw)
+    bpy.utils.unregister_class(LoadLdrawGeometry)
+    bpy.utils.unregister_class(UpdateLdrawDetail)
+    bpy.utils.unregister_class(LdrawScenePanel)
     bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
+    bpy.types.VIEW3D_MT_object.remove(menu_func_object)
     del bpy.types.Object.ldrawInheritsColor
+    del bpy.types.Object.ldrawFile
+    del bpy.types.Object.ldrawManifest
+    del bpy.types.Mesh.ldrawPart
+    del bpy.types.Mesh.ldrawHash
+    del bpy.types.Scene.ldrawDetail
+    del bpy.types.Scene.ldrawDetailDistances
+    bpy.app.handlers.frame_change_pre.remove(detailFrameChange)
+    bpy.app.handlers.render_init.remove(renderStarted)
+    bpy.app.handlers.render_complete.remove(renderEnded)
+    bpy.app.handlers.render_cancel.remove(renderEnded)
 
 if __name__ == "__main__":
     register()
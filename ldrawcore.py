@@ -0,0 +1,1727 @@
+"""\
+Blender-independent LDraw parsing core.
+
+Turns the text of .dat/.ldr/.mpd files into a compact intermediate
+representation (LDrawFile) made of flat arrays, so that files can be parsed,
+profiled and cached without running Blender. The importer in ldraw.py builds
+its meshes and objects from these.
+
+Usage:
+    python ldrawcore.py FILE [FILE ...]
+    Parses the given files and prints the parse throughput.
+"""
+
+import sys, os, io, math, time, warnings, json, struct, hashlib, mmap
+import re, collections, collections.abc, contextlib, functools, zipfile
+import multiprocessing, concurrent.futures
+from array import array
+import numpy
+
+THRESHOLD = 0.0001
+CW = 0
+CCW = 1
+
+# Direct colors ("0x2RRGGBB") are stored as their integer value, which never
+# collides with a palette code
+DIRECTCOLOR = 0x2000000
+BADCOLOR = -1
+
+# faceFlags bits
+FACE_CULL = 1
+FACE_SMOOTH = 2
+# refFlags bits
+REF_INVERT = 1
+REF_NOCLIP = 2
+
+### PROFILING ###
+
+class Profile(object):
+    """
+    Import instrumentation: exclusive time spent in each phase (time in a
+    nested phase only counts towards the innermost one), and counters per
+    file, such as lines, faces, verts, references and cache hits.
+
+    A disabled Profile costs one attribute check per instrumented call.
+
+    >>> p = Profile()
+    >>> with p.phase('parsing'):
+    ...     p.count('3001.dat', 'faces', 12)
+    >>> p.report()['parts']['3001.dat']
+    {'faces': 12}
+    """
+    def __init__(self, enabled=True, top=20):
+        self.enabled = enabled
+        self.top = top
+        self.phases = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.parts = collections.defaultdict(lambda: collections.defaultdict(int))
+        self.stack = []
+        self.started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def _phase(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            outer = self.stack[-1]
+            self.phases[outer[0]] += now - outer[1]
+        self.stack.append([name, now])
+        self.calls[name] += 1
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.phases[name] += now - self.stack.pop()[1]
+            if self.stack:
+                self.stack[-1][1] = now
+
+    def phase(self, name):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._phase(name)
+
+    def count(self, part, key, n=1):
+        if self.enabled:
+            self.parts[part][key] += n
+
+    def report(self):
+        ranked = sorted(self.parts.items(), key=lambda item: item[1].get('seconds', 0.0), reverse=True)
+        return {'seconds': time.perf_counter()-self.started,
+                'phases': {name: {'seconds': seconds, 'calls': self.calls[name]}
+                           for name, seconds in self.phases.items()},
+                'parts': {name: dict(counters) for name, counters in self.parts.items()},
+                'top': [dict(counters, name=name) for name, counters in ranked[:self.top]
+                        if 'seconds' in counters]}
+
+    def summary(self):
+        report = self.report()
+        lines = ["Import profile ({0:.4} seconds):".format(report['seconds'])]
+        for name, phase in sorted(report['phases'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append("  {0:<12} {1:9.4f} s  {2:8d} calls".format(name, phase['seconds'], phase['calls']))
+        if report['top']:
+            lines.append("Most expensive files:")
+            for part in report['top']:
+                lines.append("  {0:<24} {1:9.4f} s  {2:7d} faces  {3:7d} verts".format(
+                    part['name'], part['seconds'], part.get('faces', 0), part.get('verts', 0)))
+        return '\n'.join(lines)
+
+PROFILE = Profile(enabled=False)
+
+def profiled(phase):
+    """
+    Decorator that counts the time spent in a function towards a phase of
+    PROFILE.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILE.enabled:
+                return func(*args, **kwargs)
+            with PROFILE.phase(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+### UTILITY FUNCTIONS ###
+
+class BFCContext(object):
+    def __init__(self, other=None, copy=False):
+        if copy:
+            self.localCull = other.localCull
+            self.winding = other.winding
+            self.invertNext = other.invertNext
+            self.certified = other.certified
+            self.accumCull = other.accumCull
+            self.accumInvert = other.accumInvert
+        else:
+            self.localCull = True
+            self.winding = CCW
+            self.invertNext = False
+            self.certified = None
+            if other is not None and other.certified:
+                self.certified = True
+                self.accumCull = other.accumCull and other.localCull
+                self.accumInvert = other.accumInvert ^ other.invertNext
+            else:
+                # Only the top of the tree can cull without a certified
+                # parent
+                self.accumCull = other is None
+                self.accumInvert = False
+
+def parseColorCode(s):
+    """
+    >>> parseColorCode("16"), hex(parseColorCode("0x2FF8000"))
+    (16, '0x2ff8000')
+    """
+    if s.isdigit():
+        return int(s)
+    elif s.startswith("0x2"):
+        # Direct color
+        try:
+            return int(s, 16)
+        except ValueError:
+            pass
+    warnings.warn("Malformed color reference: {0}".format(s))
+    return BADCOLOR
+
+def isRoundPrimitive(fname):
+    """
+    Whether a file is a round primitive (cylinder, sphere, cone, torus...)
+    whose faces should be shaded smooth.
+
+    >>> isRoundPrimitive("4-4cyli.dat"), isRoundPrimitive("t04o1429.dat"), isRoundPrimitive("box5.dat")
+    (True, True, False)
+    """
+    fname = os.path.basename(fname.replace('\\', '/'))
+    return ((('con' in fname) and
+             (not fname.startswith('con'))) or
+            ('cyl' in fname) or
+            ('sph' in fname) or
+            fname.startswith('t0') or
+            fname.startswith('t1') or
+            ('bump' in fname))
+
+def isStud(fname):
+    """
+    Whether a file is one of the stud primitives (including the underside
+    tubes, stud3 and stud4), which far-away levels of detail leave out.
+
+    >>> isStud("stud.dat"), isStud("stud4a.dat"), isStud("48\\stud2.dat"), isStud("s/3001s01.dat")
+    (True, True, True, False)
+    """
+    return os.path.basename(fname.replace('\\', '/')).startswith('stud')
+
+def isSubpart(fname):
+    return fname[0] == 's' and fname[1:2] in ('/', '\\')
+
+class VertexWelder(object):
+    """
+    Spatial hash over a flat xyz coordinate array, so that welding a corner
+    costs a few dict lookups instead of a scan over every vertex.
+
+    Coordinates are bucketed into cells twice the weld tolerance wide, so any
+    vertex within tolerance of a point lies in that point's cell or in the
+    neighbouring cell on the nearer side along each axis.
+
+    >>> w = VertexWelder(array('d'))
+    >>> w.index(1.0, 2.0, 3.0), w.index(1.00005, 2.0, 3.0), w.index(1.0, 2.0, 4.0)
+    (0, 0, 1)
+    """
+    def __init__(self, verts, tolerance=None):
+        self.verts = verts
+        self.tolerance = THRESHOLD if tolerance is None else tolerance
+        # Keep cells non-degenerate so a zero tolerance means exact matches
+        self.cellSize = max(2.0*self.tolerance, 1e-9)
+        self.cells = {}
+
+    def find(self, x, y, z):
+        size = self.cellSize
+        fx, fy, fz = x/size, y/size, z/size
+        cx, cy, cz = math.floor(fx), math.floor(fy), math.floor(fz)
+        cells = self.cells
+        idx = self.search(cells.get((cx, cy, cz)), x, y, z)
+        if idx is not None:
+            return idx
+        # Step towards whichever neighbour the point is closer to on each axis
+        nx = -1 if fx - cx < 0.5 else 1
+        ny = -1 if fy - cy < 0.5 else 1
+        nz = -1 if fz - cz < 0.5 else 1
+        for key in ((cx+nx, cy, cz), (cx, cy+ny, cz), (cx, cy, cz+nz),
+                    (cx+nx, cy+ny, cz), (cx+nx, cy, cz+nz), (cx, cy+ny, cz+nz),
+                    (cx+nx, cy+ny, cz+nz)):
+            idx = self.search(cells.get(key), x, y, z)
+            if idx is not None:
+                return idx
+        return None
+
+    def search(self, bucket, x, y, z):
+        if bucket is None:
+            return None
+        verts = self.verts
+        tolerance = self.tolerance
+        for idx in bucket:
+            i = idx*3
+            if (abs(verts[i]-x) <= tolerance and
+                abs(verts[i+1]-y) <= tolerance and
+                abs(verts[i+2]-z) <= tolerance):
+                return idx
+        return None
+
+    def index(self, x, y, z):
+        idx = self.find(x, y, z)
+        if idx is None:
+            idx = len(self.verts)//3
+            self.verts.extend((x, y, z))
+            size = self.cellSize
+            key = (math.floor(x/size), math.floor(y/size), math.floor(z/size))
+            self.cells.setdefault(key, []).append(idx)
+        return idx
+
+### INTERMEDIATE REPRESENTATION ###
+
+class LDrawFile(object):
+    """
+    Geometry and references of one LDraw file (or one MPD section).
+
+    verts        flat xyz coordinates, welded within the file
+    faceVerts    vertex indices of every face, concatenated, in final winding
+    faceSizes    number of corners of each face (3 or 4)
+    faceColors   color code of each face
+    faceFlags    FACE_* bits of each face
+    edges        vertex index pairs of the line-type 2 records
+    condEdges    vertex index pairs of the line-type 5 (conditional) records
+    condControls the two control points of each conditional line, 6 floats
+                 apiece
+    refNames     lowercase file name of each line-type 1 reference
+    refColors    color code of each reference
+    refMatrices  row-major 3x4 matrix of each reference, 12 floats apiece
+    refFlags     REF_* bits of each reference
+    colours      (name, upper-cased tokens) of each !COLOUR meta-command
+    certified    True, False or None (no BFC statement)
+    hasData      whether the file has any geometry or references; files
+                 without are headers (like LDConfig.ldr) or empty primitives
+    """
+    __slots__ = ('name', 'verts', 'faceVerts', 'faceSizes', 'faceColors',
+                 'faceFlags', 'edges', 'condEdges', 'condControls', 'refNames',
+                 'refColors', 'refMatrices', 'refFlags', 'colours', 'certified',
+                 'hasData')
+
+    def __init__(self, name=None):
+        self.name = name
+        self.verts = array('d')
+        self.faceVerts = array('i')
+        self.faceSizes = array('B')
+        self.faceColors = array('i')
+        self.faceFlags = array('B')
+        self.edges = array('i')
+        self.condEdges = array('i')
+        self.condControls = array('d')
+        self.refNames = []
+        self.refColors = array('i')
+        self.refMatrices = array('d')
+        self.refFlags = array('B')
+        self.colours = []
+        self.certified = None
+        self.hasData = False
+
+    def __getstate__(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+    @property
+    def vertCount(self):
+        return len(self.verts)//3
+
+    @property
+    def faceCount(self):
+        return len(self.faceSizes)
+
+    @property
+    def refCount(self):
+        return len(self.refNames)
+
+### PARSER ###
+
+def lineType0(line, bfc, parsed):
+    # Comment or meta-command
+    if len(line) < 2:
+        return
+    if line[1] == '!COLOUR':
+        name = line[2].strip()
+        parsed.colours.append((name, [s.upper() for s in line]))
+
+    elif line[1] == "BFC":
+        # http://www.ldraw.org/article/415
+        for option in line[2:]:
+            if option == "CERTIFY":
+                if bfc.certified is False:
+                    warnings.warn("{0}: BFC CERTIFY after NOCERTIFY".format(parsed.name))
+                bfc.certified = True
+            elif option == "NOCERTIFY":
+                if bfc.certified:
+                    warnings.warn("{0}: BFC NOCERTIFY after CERTIFY".format(parsed.name))
+                bfc.certified = False
+            elif option == "CLIP":
+                bfc.localCull = True
+            elif option == "NOCLIP":
+                bfc.localCull = False
+            elif option == "CCW":
+                # According to the spec, winding should alternate depending on
+                # accumInvert. However, for an importer, since accumInvert
+                # depends on the files above in the hierarchy, we should only
+                # use locally-specified winding, then invert when collapsing
+                # the mesh
+                bfc.winding = CCW
+            elif option == "CW":
+                bfc.winding = CW
+            elif option == "INVERTNEXT":
+                bfc.invertNext = True
+
+# Where each of the numbers of a line-type 1 record (x y z a b c d e f g h i)
+# goes in a row-major 3x4 matrix
+REFCOLUMNS = numpy.array([3, 4, 5, 0, 6, 7, 8, 1, 9, 10, 11, 2])
+
+def lineType1(line, bfc, parsed, colors, numbers):
+    # File reference. The name is everything after the 14th field, and may
+    # itself contain spaces. The color and numbers are only collected, and
+    # converted for the whole file at once by finishReferences.
+    line = line.split(None, 14)
+    if len(line) < 15:
+        return
+    parsed.refNames.append(line[14].lower())
+    colors.append(line[1])
+    numbers.extend(line[2:14])
+    parsed.refFlags.append((REF_INVERT if bfc.invertNext else 0) |
+                           (0 if bfc.localCull else REF_NOCLIP))
+
+def finishReferences(parsed, colors, numbers):
+    """
+    Convert the colors and numbers lineType1 collected in bulk, dropping
+    references with malformed numbers.
+
+    >>> f = parseLines(["1 4 1 2 3 1 0 0 0 1 0 0 0 1 a.dat",
+    ...                 "1 4 0 0 0 x 0 0 0 1 0 0 0 1 b.dat",
+    ...                 "1 0x2FF0000 0 0 0 1 0 0 0 1 0 0 0 1 c.dat"])
+    >>> f.refNames, list(f.refColors), list(f.refMatrices[:4])
+    (['a.dat', 'c.dat'], [4, 50266112], [1.0, 0.0, 0.0, 1.0])
+    """
+    if not colors:
+        return
+    try:
+        matrices = numpy.array(numbers, dtype=numpy.float64).reshape(-1, 12)
+    except ValueError:
+        keep = []
+        for i in range(len(colors)):
+            try:
+                numpy.array(numbers[i*12:i*12+12], dtype=numpy.float64)
+                keep.append(i)
+            except ValueError as e:
+                warnings.warn("{0}: {1}".format(parsed.name, e))
+        parsed.refNames = [parsed.refNames[i] for i in keep]
+        parsed.refFlags = array('B', [parsed.refFlags[i] for i in keep])
+        colors = [colors[i] for i in keep]
+        numbers = [n for i in keep for n in numbers[i*12:i*12+12]]
+        matrices = numpy.array(numbers, dtype=numpy.float64).reshape(-1, 12)
+    parsed.refMatrices.frombytes(matrices[:, REFCOLUMNS].tobytes())
+    try:
+        # Plain decimal codes, the common case
+        parsed.refColors.extend(map(int, colors))
+    except ValueError:
+        del parsed.refColors[:]
+        parsed.refColors.extend(map(parseColorCode, colors))
+
+def poly(line, bfc, parsed, welder, seenFaces):
+    # helper function for making polygons
+    vertices = []
+    for i in range(2, len(line), 3):
+        vertices.append(welder.index(float(line[i]), float(line[i+1]), float(line[i+2])))
+    if bfc.winding == CW:
+        vertices.reverse()
+    key = tuple(sorted(vertices))
+    if len(set(key)) != len(key):
+        raise ValueError("{0}: face has duplicate vertices".format(parsed.name))
+    if bfc.certified and bfc.localCull:
+        # Under BFC, the same face in both windings is a two-sided surface,
+        # so only the same winding repeats a face
+        first = vertices.index(key[0])
+        key = tuple(vertices[first:] + vertices[:first])
+    if key in seenFaces:
+        raise ValueError("{0}: face already exists".format(parsed.name))
+    seenFaces.add(key)
+    parsed.faceVerts.extend(vertices)
+    parsed.faceSizes.append(len(vertices))
+    parsed.faceColors.append(parseColorCode(line[1]))
+    parsed.faceFlags.append(FACE_CULL if bfc.localCull else 0)
+
+def lineType2(line, parsed, welder, seenEdges):
+    a = welder.index(float(line[2]), float(line[3]), float(line[4]))
+    b = welder.index(float(line[5]), float(line[6]), float(line[7]))
+    if a == b:
+        raise ValueError("{0}: line has zero length".format(parsed.name))
+    key = (a, b) if a < b else (b, a)
+    if key not in seenEdges:
+        seenEdges.add(key)
+        parsed.edges.extend(key)
+
+def lineType5(line, parsed, welder, seenConditionals):
+    # The control points only decide whether the line shows, so they are
+    # kept apart from the vertices
+    a = welder.index(float(line[2]), float(line[3]), float(line[4]))
+    b = welder.index(float(line[5]), float(line[6]), float(line[7]))
+    controls = [float(n) for n in line[8:14]]
+    if len(controls) != 6:
+        raise ValueError("{0}: conditional line needs two control points".format(parsed.name))
+    if a == b:
+        raise ValueError("{0}: line has zero length".format(parsed.name))
+    key = (a, b) if a < b else (b, a)
+    if key not in seenConditionals:
+        seenConditionals.add(key)
+        parsed.condEdges.extend((a, b))
+        parsed.condControls.extend(controls)
+
+@profiled('parsing')
+def parseLines(lines, name=None, tolerance=None):
+    """
+    Parse an iterable of LDraw text lines into an LDrawFile.
+
+    >>> f = parseLines(["0 BFC CERTIFY CW",
+    ...                 "1 16 0 0 0 1 0 0 0 1 0 0 0 1 stud 2.dat",
+    ...                 "3 4 0 0 0 1 0 0 0 1 0",
+    ...                 "2 24 0 0 0 1 0 0"])
+    >>> f.certified, f.refNames, list(f.faceVerts), list(f.faceColors), list(f.edges)
+    (True, ['stud 2.dat'], [2, 1, 0], [4], [0, 1])
+
+    A face repeated in the other winding is dropped, unless BFC makes each
+    one visible from one side only:
+
+    >>> twoSided = ["3 16 0 0 0 1 0 0 0 1 0", "3 16 0 1 0 1 0 0 0 0 0"]
+    >>> with warnings.catch_warnings():
+    ...     warnings.simplefilter('ignore')
+    ...     parseLines(twoSided).faceCount, parseLines(["0 BFC CERTIFY"] + twoSided).faceCount
+    (1, 2)
+    """
+    parsed = LDrawFile(name)
+    bfc = BFCContext()
+    welder = VertexWelder(parsed.verts, tolerance)
+    seenFaces = set()
+    seenEdges = set()
+    seenConditionals = set()
+    refColors = []
+    refNumbers = []
+    count = 0
+    for count, line in enumerate(lines, 1):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        command = line[0] if line[1:2] in ' \t' else line.split(None, 1)[0]
+        if command == '0':
+            # Comment or meta-command
+            sline = line.split()
+            lineType0(sline, bfc, parsed)
+            if len(sline) < 2 or sline[1] != "BFC":
+                bfc.invertNext = False
+        elif command == '1':
+            lineType1(line, bfc, parsed, refColors, refNumbers)
+            bfc.invertNext = False
+            parsed.hasData = True
+        elif command in ('3', '4'):
+            # Tri or quad (poly)
+            try:
+                poly(line.split(), bfc, parsed, welder, seenFaces)
+            except (ValueError, IndexError) as e:
+                warnings.warn(str(e))
+            bfc.invertNext = False
+            parsed.hasData = True
+        elif command == '2':
+            # Line
+            try:
+                lineType2(line.split(), parsed, welder, seenEdges)
+            except (ValueError, IndexError) as e:
+                warnings.warn(str(e))
+            bfc.invertNext = False
+            parsed.hasData = True
+        elif command == '5':
+            # Conditional line
+            try:
+                lineType5(line.split(), parsed, welder, seenConditionals)
+            except (ValueError, IndexError) as e:
+                warnings.warn(str(e))
+            bfc.invertNext = False
+            parsed.hasData = True
+        else:
+            warnings.warn("Unknown linetype %s\n" % command)
+    finishReferences(parsed, refColors, refNumbers)
+    parsed.certified = bfc.certified
+    PROFILE.count(name, 'lines', count)
+    return parsed
+
+class MPDFile(collections.abc.Mapping):
+    """
+    The sections of a multi-part file, as a mapping of section names to
+    LDrawFiles.
+
+    Sections are found with one pass over a memory-mapped copy of the file
+    and kept as byte ranges; each is decoded and parsed the first time it is
+    looked up, and only once however often it is referenced.
+
+    >>> mpd = MPDFile(b"0 FILE a.ldr\\n1 16 0 0 0 1 0 0 0 1 0 0 0 1 b.ldr\\n0 NOFILE\\n0 FILE B.ldr\\n3 4 0 0 0 1 0 0 0 1 0\\n", "x.mpd")
+    >>> mpd.firstName, sorted(mpd), mpd['a.ldr'].refNames, mpd['b.ldr'].faceCount
+    ('a.ldr', ['a.ldr', 'b.ldr'], ['b.ldr'], 1)
+    """
+    HEADER = re.compile(rb'^0[ \t]+(FILE|NOFILE)(?=\s|$)([^\r\n]*)', re.MULTILINE)
+
+    @profiled('parsing')
+    def __init__(self, buffer, fname, tolerance=None):
+        self.buffer = buffer
+        self.tolerance = tolerance
+        self.sections = {}
+        self.parsed = {}
+        self.firstName = None
+        name = None
+        start = 0
+        for match in self.HEADER.finditer(buffer):
+            if name is not None:
+                self.sections[name] = start, match.start()
+            if match.group(1) == b'FILE':
+                name = match.group(2).strip().decode('utf-8', 'replace').lower()
+                start = buffer.find(b'\n', match.end())
+                start = len(buffer) if start == -1 else start+1
+                if self.firstName is None:
+                    self.firstName = name
+            else:
+                name = None
+        if name is not None:
+            self.sections[name] = start, len(buffer)
+        if self.firstName is None:
+            # This is if it wasn't actually multi-part (as is the case with most LDRs)
+            self.firstName = fname.lower()
+            self.sections[self.firstName] = 0, len(buffer)
+        # "When an MPD file is used to store a multi-file model, the first
+        # file in the MPD is treated as the 'main model'"
+
+    @classmethod
+    def open(cls, path, fname=None, tolerance=None):
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            archive, member = archiveMember(path)
+            if archive is None:
+                raise
+            buffer = archive.read(member)
+        else:
+            with f:
+                try:
+                    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError:
+                    # Empty file
+                    buffer = b''
+        return cls(buffer, os.path.basename(path) if fname is None else fname, tolerance)
+
+    def close(self):
+        # Unmaps the file. Sections parsed by then stay available.
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def raw(self, name):
+        start, end = self.sections[name]
+        return self.buffer[start:end]
+
+    def __getitem__(self, name):
+        if name not in self.parsed:
+            text = self.raw(name).decode('utf-8', 'replace')
+            self.parsed[name] = parseLines(text.splitlines(), name, self.tolerance)
+        return self.parsed[name]
+
+    def __contains__(self, name):
+        return name in self.sections
+
+    def __iter__(self):
+        return iter(self.sections)
+
+    def __len__(self):
+        return len(self.sections)
+
+def sectionHashes(model, stamp):
+    """
+    A hash of every section of an MPDFile that changes whenever the section
+    or anything it references does: sections it references contribute their
+    own hashes, other files stamp(name) (such as fileStamp of their path).
+
+    >>> mpd = MPDFile(b"0 FILE a.ldr\\n1 16 0 0 0 1 0 0 0 1 0 0 0 1 b.ldr\\n0 FILE b.ldr\\n0 FILE c.ldr\\n", "x.mpd")
+    >>> edited = MPDFile(b"0 FILE a.ldr\\n1 16 0 0 0 1 0 0 0 1 0 0 0 1 b.ldr\\n0 FILE b.ldr\\n0 // x\\n0 FILE c.ldr\\n", "x.mpd")
+    >>> old, new = sectionHashes(mpd, str), sectionHashes(edited, str)
+    >>> [old[name] == new[name] for name in sorted(old)]
+    [False, False, True]
+    """
+    hashes = {}
+
+    def visit(name, active):
+        if name in hashes:
+            return hashes[name]
+        h = hashlib.sha1(model.raw(name))
+        active.add(name)
+        for child in dict.fromkeys(model[name].refNames):
+            if child in model:
+                # A reference back to a section being hashed is only known
+                # by name
+                h.update(b'S' + (child.encode() if child in active else visit(child, active).encode()))
+            else:
+                h.update(b'F' + json.dumps([child, stamp(child)]).encode())
+        active.discard(name)
+        hashes[name] = h.hexdigest()
+        return hashes[name]
+
+    for name in model:
+        visit(name, set())
+    return hashes
+
+def parseFile(path, tolerance=None):
+    """
+    Parse a file on disk. Returns the name of the main model and a dict of
+    LDrawFiles, which has one entry per MPD section (or just one for plain
+    files).
+    """
+    fname = os.path.basename(path)
+    if os.path.splitext(fname)[1].lower() in ('.mpd', '.ldr'):
+        model = MPDFile.open(path, fname, tolerance)
+        return model.firstName, dict(model)
+    else:
+        name = fname.lower()
+        with open(path) as f:
+            return name, {name: parseLines(f, name, tolerance)}
+
+def colourTable(colours):
+    """
+    !COLOUR meta-commands, as (name, tokens) pairs, keyed by color code.
+
+    >>> colourTable(parseLines(["0 !COLOUR Red CODE 4 VALUE #B40000 EDGE #333333"]).colours)
+    {4: ('Red', ['0', '!COLOUR', 'RED', 'CODE', '4', 'VALUE', '#B40000', 'EDGE', '#333333'])}
+    """
+    table = {}
+    for name, tokens in colours:
+        if 'CODE' not in tokens[:-1]:
+            warnings.warn("!COLOUR {0} has no CODE".format(name))
+            continue
+        code = parseColorCode(tokens[tokens.index('CODE')+1])
+        if code != BADCOLOR:
+            table[code] = name, tokens
+    return table
+
+_PALETTES = {}
+
+def loadPalette(path):
+    """
+    The colourTable of an LDConfig file. It is parsed once, and again only
+    when the file's mtime or size change.
+    """
+    stamp = fileStamp(path)
+    if path not in _PALETTES or _PALETTES[path][0] != stamp:
+        with openLibraryFile(path) as f:
+            _PALETTES[path] = stamp, colourTable(parseLines(f, os.path.basename(path)).colours)
+    return _PALETTES[path][1]
+
+### LIBRARY ###
+
+def libraryName(fname):
+    """
+    The form file names take in a LibraryIndex: lowercase, with forward
+    slashes.
+
+    >>> libraryName("S\\\\3001s01.DAT")
+    's/3001s01.dat'
+    """
+    return fname.replace('\\', '/').replace(os.path.sep, '/').lower()
+
+# Bytes of decompressed archive members kept in memory, per archive
+ARCHIVECACHE = 0
+
+class LibraryArchive(object):
+    """
+    An LDraw library packed in a zip file, such as complete.zip. The central
+    directory is read once, when the archive is opened, and members are
+    only decompressed when read. The most recently read members are kept,
+    up to ARCHIVECACHE bytes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.zip = zipfile.ZipFile(path)
+        self.members = {info.filename: info for info in self.zip.infolist() if not info.filename.endswith('/')}
+        self.cached = collections.OrderedDict()
+        self.cachedBytes = 0
+
+    def read(self, member):
+        if member in self.cached:
+            self.cached.move_to_end(member)
+            return self.cached[member]
+        data = self.zip.read(self.members[member])
+        if len(data) <= ARCHIVECACHE:
+            self.cached[member] = data
+            self.cachedBytes += len(data)
+        while self.cachedBytes > ARCHIVECACHE:
+            self.cachedBytes -= len(self.cached.popitem(last=False)[1])
+        return data
+
+    def stamp(self, member):
+        # Like fileStamp, but from the central directory
+        info = self.members[member]
+        return [info.CRC, info.file_size]
+
+_ARCHIVES = {}
+
+def openArchive(path):
+    """
+    The LibraryArchive of a zip file, opened once per process, and again
+    only when the file's mtime or size change.
+    """
+    stamp = fileStamp(path)
+    if path not in _ARCHIVES or _ARCHIVES[path][0] != stamp:
+        _ARCHIVES[path] = stamp, LibraryArchive(path)
+    return _ARCHIVES[path][1]
+
+def archiveMember(path):
+    """
+    Files inside a zip archive have the path of the archive joined with the
+    member's name, as if the archive were a directory. Returns the
+    LibraryArchive and member name of such a path, or (None, None).
+    """
+    for archivePath in _ARCHIVES:
+        if path.startswith(archivePath + os.sep):
+            break
+    else:
+        # Only a path under a file can be inside an archive
+        archivePath = path
+        while not os.path.isfile(archivePath):
+            parent = os.path.dirname(archivePath)
+            if parent == archivePath:
+                return None, None
+            archivePath = parent
+        if archivePath == path or not zipfile.is_zipfile(archivePath):
+            return None, None
+    member = os.path.relpath(path, archivePath).replace(os.sep, '/')
+    archive = openArchive(archivePath)
+    return (archive, member) if member in archive.members else (None, None)
+
+def openLibraryFile(path):
+    """
+    Opens a library file as text, whether it is on disk or inside a zip
+    archive (see archiveMember).
+    """
+    try:
+        return open(path)
+    except OSError:
+        archive, member = archiveMember(path)
+        if archive is None:
+            raise
+        return io.StringIO(archive.read(member).decode('utf-8', 'replace'))
+
+def librarySources(ldrawDir):
+    """
+    What a library is read from: a directory, or zip files separated by
+    os.pathsep, official library first.
+
+    >>> librarySources(os.pathsep.join(["complete.zip", "ldrawunf.zip"]))
+    ['complete.zip', 'ldrawunf.zip']
+    """
+    if os.path.isdir(ldrawDir):
+        return [ldrawDir]
+    return [source for source in ldrawDir.split(os.pathsep) if source] or [ldrawDir]
+
+class LibraryIndex(object):
+    """
+    Every file of an LDraw library, found with one walk of its directories
+    and looked up by lowercase name, so resolving a reference costs no
+    filesystem access at all.
+
+    The library can also be zip files (see librarySources): the official
+    complete.zip, with or without its top "ldraw" directory, and after it
+    zips of unofficial parts, whose parts and p directories are indexed as
+    unofficial ones. Only the archives' central directories are read.
+
+    With persist, the index is saved to the cache directory and reused by
+    later sessions for as long as none of the library's directories (or
+    archives) change.
+    """
+    VERSION = 2
+    # Official directories, then their unofficial counterparts. p/48 and p/8
+    # are found inside p, as "48/..." and "8/..."
+    ROOTS = ('parts', 'p', 'models', 'unofficial/parts', 'unofficial/p')
+
+    def __init__(self, ldrawDir, persist=False):
+        self.ldrawDir = ldrawDir
+        self.roots = {root: {} for root in self.ROOTS}
+        self.stamps = {}
+        # The library's LDConfig.ldr
+        self.config = None
+        # Part names by path, for partName
+        self.partPaths = None
+        if not (persist and self.load()):
+            self.build()
+            if persist:
+                self.save()
+
+    def findDir(self, top, relative):
+        # Case-insensitive, since libraries extracted on different systems
+        # disagree about "PARTS" and "parts"
+        path = top
+        for component in relative.split('/'):
+            try:
+                entries = os.listdir(path)
+            except OSError:
+                return None
+            for entry in entries:
+                if entry.lower() == component and os.path.isdir(os.path.join(path, entry)):
+                    path = os.path.join(path, entry)
+                    break
+            else:
+                return None
+        return path
+
+    def build(self):
+        for number, source in enumerate(librarySources(self.ldrawDir)):
+            if os.path.isfile(source):
+                self.buildArchive(source, unofficial=number > 0)
+            else:
+                self.buildTree(source)
+
+    def buildArchive(self, path, unofficial):
+        self.stamps[path] = os.stat(path).st_mtime_ns
+        for member in openArchive(path).members:
+            name = member.lower()
+            if name.startswith('ldraw/'):
+                name = name[len('ldraw/'):]
+            if unofficial and not name.startswith('unofficial/'):
+                name = 'unofficial/' + name
+            memberPath = os.path.join(path, *member.split('/'))
+            if name == 'ldconfig.ldr':
+                self.config = self.config or memberPath
+            for root in self.ROOTS:
+                if name.startswith(root + '/'):
+                    self.roots[root].setdefault(name[len(root)+1:], memberPath)
+                    break
+
+    def buildTree(self, ldrawDir):
+        for root in self.ROOTS:
+            top = self.findDir(ldrawDir, root)
+            if top is None:
+                continue
+            names = self.roots[root]
+            for dirpath, dirnames, filenames in os.walk(top):
+                self.stamps[dirpath] = os.stat(dirpath).st_mtime_ns
+                prefix = os.path.relpath(dirpath, top)
+                prefix = '' if prefix == os.curdir else libraryName(prefix) + '/'
+                for filename in filenames:
+                    names.setdefault(prefix + filename.lower(), os.path.join(dirpath, filename))
+        # The top of the library too, so new root directories are noticed
+        self.stamps[ldrawDir] = os.stat(ldrawDir).st_mtime_ns if os.path.isdir(ldrawDir) else 0
+        if os.path.isdir(ldrawDir) and self.config is None:
+            for entry in os.listdir(ldrawDir):
+                if entry.lower() == 'ldconfig.ldr':
+                    self.config = os.path.join(ldrawDir, entry)
+
+    def indexPath(self):
+        key = hashlib.sha1(os.path.abspath(self.ldrawDir).encode('utf-8')).hexdigest()
+        return os.path.join(cacheDir(), 'index-' + key + '.json')
+
+    def load(self):
+        try:
+            with open(self.indexPath()) as f:
+                data = json.load(f)
+            if data['version'] != self.VERSION:
+                return False
+            for path, stamp in data['stamps'].items():
+                if os.stat(path).st_mtime_ns != stamp:
+                    return False
+        except (OSError, ValueError, KeyError):
+            return False
+        self.roots.update(data['roots'])
+        self.stamps = data['stamps']
+        self.config = data['config']
+        return True
+
+    def save(self):
+        path = self.indexPath()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump({'version': self.VERSION, 'stamps': self.stamps, 'roots': self.roots,
+                           'config': self.config}, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            warnings.warn("Could not save library index: {0}".format(e))
+
+    def find(self, fname, hires=False, lowres=False):
+        name = libraryName(fname)
+        for official in ('', 'unofficial/'):
+            candidates = [(official+'parts', name)]
+            if lowres:
+                candidates.append((official+'p', '8/'+name))
+            if hires:
+                candidates.append((official+'p', '48/'+name))
+            candidates.append((official+'p', name))
+            if not official:
+                candidates.append(('models', name))
+            for root, key in candidates:
+                path = self.roots[root].get(key)
+                if path is not None:
+                    return path
+        return None
+
+    def isPart(self, fname):
+        name = libraryName(fname)
+        return name in self.roots['parts'] or name in self.roots['unofficial/parts']
+
+    def partName(self, path):
+        """
+        The name a part is referenced by, for a file given by its full path,
+        or None if the file isn't one of the library's parts (or another part
+        of that name is found first).
+
+        >>> import tempfile
+        >>> top = tempfile.mkdtemp()
+        >>> os.makedirs(os.path.join(top, 'parts', 's'))
+        >>> for name in ('3001.dat', os.path.join('s', '3001s01.dat')):
+        ...     open(os.path.join(top, 'parts', name), 'w').close()
+        >>> index = LibraryIndex(top)
+        >>> index.partName(os.path.join(top, 'parts', 's', '3001s01.dat'))
+        's/3001s01.dat'
+        >>> index.partName(os.path.join(top, 'models', '3001.dat')) is None
+        True
+        """
+        if self.partPaths is None:
+            self.partPaths = {os.path.normcase(os.path.abspath(partPath)): name
+                              for root in ('parts', 'unofficial/parts')
+                              for name, partPath in self.roots[root].items()}
+        path = os.path.normcase(os.path.abspath(path))
+        name = self.partPaths.get(path)
+        if name is None or os.path.normcase(os.path.abspath(self.find(name))) != path:
+            return None
+        return name
+
+class Library(object):
+    """
+    Finds and parses files from an LDraw library directory. Lookups go
+    through a LibraryIndex and are remembered, misses included, and parsed
+    files are kept for the lifetime of the Library, so each primitive is
+    only read once per import.
+    """
+    def __init__(self, ldrawDir, hires=False, lowres=False, tolerance=None, index=None):
+        self.ldrawDir = ldrawDir
+        self.hires = hires
+        self.lowres = lowres
+        self.tolerance = tolerance
+        self.index = LibraryIndex(ldrawDir) if index is None else index
+        self.found = {}
+        self.parsed = {}
+
+    @profiled('resolution')
+    def find(self, fname):
+        if fname not in self.found:
+            path = None
+            if os.path.isabs(fname) and os.path.exists(fname):
+                # A model given by its full path
+                path = fname
+            else:
+                path = self.index.find(fname, self.hires, self.lowres)
+            self.found[fname] = path
+        return self.found[fname]
+
+    def isPart(self, fname):
+        return self.index.isPart(fname)
+
+    def load(self, fname):
+        """
+        Returns the parsed file and the path it was read from, or (None, None)
+        if it cannot be found.
+        """
+        if fname in self.parsed:
+            return self.parsed[fname]
+        path = self.find(fname)
+        if path is None:
+            warnings.warn("Could not find file %s" % fname)
+            result = None, None
+        else:
+            with openLibraryFile(path) as f:
+                result = parseLines(f, fname, self.tolerance), path
+        self.parsed[fname] = result
+        return result
+
+### FLATTENING ###
+
+def slotLayout(colors):
+    """
+    Material slots for an array of face colors: the color of each slot, in
+    order of first use after the inherited slot 0, and the slot of each face.
+
+    >>> [a.tolist() for a in slotLayout(numpy.array([4, 16, 24, 1, 4]))]
+    [[16, 4, 1], [1, 0, 0, 2, 1]]
+    """
+    colors = numpy.asarray(colors, dtype=numpy.int32)
+    explicit = (colors != 16) & (colors != 24)
+    uniq, first, inverse = numpy.unique(colors[explicit], return_index=True, return_inverse=True)
+    order = numpy.argsort(first)
+    rank = numpy.empty(len(uniq), dtype=numpy.uint16)
+    rank[order] = numpy.arange(1, len(uniq)+1)
+    faceSlots = numpy.zeros(len(colors), dtype=numpy.uint16)
+    faceSlots[explicit] = rank[inverse.ravel()]
+    slotColors = numpy.concatenate((numpy.array([16], dtype=numpy.int32), uniq[order].astype(numpy.int32)))
+    return slotColors, faceSlots
+
+class FlatMesh(object):
+    """
+    Geometry of a file with all of its references inlined, ready to become
+    one mesh. The arrays are NumPy arrays.
+
+    verts, faceVerts, faceSizes, faceFlags, edges, condEdges and condControls
+    are as in LDrawFile.
+    slotColors   color code of each material slot; slot 0 is always 16, the
+                 color inherited from whatever references the mesh
+    faceSlots    material slot of each face
+    colours      !COLOUR meta-commands of every file involved
+    certified    whether every file involved is BFC certified
+    deps         paths of every library file involved
+    missing      names of referenced files that could not be found
+    """
+    __slots__ = ('name', 'verts', 'faceVerts', 'faceSizes', 'faceSlots',
+                 'faceFlags', 'edges', 'condEdges', 'condControls', 'slotColors',
+                 'colours', 'certified', 'hasData', 'deps', 'missing')
+
+    def __init__(self, name=None):
+        self.name = name
+        self.verts = numpy.zeros(0, dtype=numpy.float64)
+        self.faceVerts = numpy.zeros(0, dtype=numpy.int32)
+        self.faceSizes = numpy.zeros(0, dtype=numpy.uint8)
+        self.faceSlots = numpy.zeros(0, dtype=numpy.uint16)
+        self.faceFlags = numpy.zeros(0, dtype=numpy.uint8)
+        self.edges = numpy.zeros(0, dtype=numpy.int32)
+        self.condEdges = numpy.zeros(0, dtype=numpy.int32)
+        self.condControls = numpy.zeros(0, dtype=numpy.float64)
+        self.slotColors = numpy.array([16], dtype=numpy.int32)
+        self.colours = []
+        self.certified = None
+        self.hasData = False
+        self.deps = set()
+        self.missing = set()
+
+    __getstate__ = LDrawFile.__getstate__
+    __setstate__ = LDrawFile.__setstate__
+
+    vertCount = LDrawFile.vertCount
+    faceCount = LDrawFile.faceCount
+
+    @classmethod
+    def fromFile(cls, parsed, smooth=False):
+        """
+        The geometry of a single file, without its references.
+
+        >>> f = FlatMesh.fromFile(parseLines(["3 16 0 0 0 1 0 0 0 1 0", "3 4 0 0 0 0 0 1 0 1 0"]))
+        >>> f.slotColors.tolist(), f.faceSlots.tolist()
+        ([16, 4], [0, 1])
+        """
+        flat = cls(parsed.name)
+        flat.verts = numpy.array(parsed.verts, dtype=numpy.float64)
+        flat.faceVerts = numpy.array(parsed.faceVerts, dtype=numpy.int32)
+        flat.faceSizes = numpy.array(parsed.faceSizes, dtype=numpy.uint8)
+        flat.faceFlags = numpy.array(parsed.faceFlags, dtype=numpy.uint8)
+        if smooth:
+            flat.faceFlags |= FACE_SMOOTH
+        if not parsed.certified:
+            # Faces of files without BFC are seen from both sides
+            flat.faceFlags &= ~numpy.uint8(FACE_CULL)
+        flat.slotColors, flat.faceSlots = slotLayout(parsed.faceColors)
+        flat.edges = numpy.array(parsed.edges, dtype=numpy.int32)
+        flat.condEdges = numpy.array(parsed.condEdges, dtype=numpy.int32)
+        flat.condControls = numpy.array(parsed.condControls, dtype=numpy.float64)
+        flat.colours = list(parsed.colours)
+        flat.certified = parsed.certified
+        flat.hasData = parsed.hasData
+        return flat
+
+    def bounds(self):
+        """
+        Opposite corners of the axis-aligned bounding box, or None if there
+        are no vertices.
+
+        >>> f = FlatMesh(); f.verts = numpy.array([0.0, 2, -1, 3, 1, 4])
+        >>> f.bounds()
+        [[0.0, 1.0, -1.0], [3.0, 2.0, 4.0]]
+        """
+        if not len(self.verts):
+            return None
+        verts = self.verts.reshape(-1, 3)
+        return [verts.min(axis=0).tolist(), verts.max(axis=0).tolist()]
+
+    def digest(self, salt=''):
+        """
+        A hash of the geometry alone: vertices (to 1e-4 units), faces, edges,
+        conditional lines, face flags and the colors of the material slots,
+        but not the name of the file it came from. salt is hashed in too.
+
+        >>> a = FlatMesh.fromFile(parseLines(["3 4 0 0 0 1 0 0 0 1 0"], name="a.dat"))
+        >>> b = FlatMesh.fromFile(parseLines(["3 4 0 0 -0.0 1 0 0 0 1.00001 0"], name="b.dat"))
+        >>> c = FlatMesh.fromFile(parseLines(["3 1 0 0 0 1 0 0 0 1 0"], name="c.dat"))
+        >>> a.digest() == b.digest(), a.digest() == c.digest(), a.digest() == a.digest('x')
+        (True, False, False)
+        """
+        h = hashlib.sha1()
+        # Adding 0.0 turns -0.0 into 0.0
+        h.update((numpy.round(numpy.asarray(self.verts, dtype=numpy.float64), 4) + 0.0).tobytes())
+        for array, dtype in ((self.faceVerts, numpy.int32), (self.faceSizes, numpy.uint8),
+                             (self.faceSlots, numpy.uint16), (self.faceFlags, numpy.uint8),
+                             (self.edges, numpy.int32), (self.condEdges, numpy.int32),
+                             (numpy.round(self.condControls, 4) + 0.0, numpy.float64),
+                             (self.slotColors, numpy.int32)):
+            array = numpy.asarray(array, dtype=dtype)
+            h.update(struct.pack('<Q', len(array)))
+            h.update(array.tobytes())
+        h.update(salt.encode('utf-8'))
+        return h.hexdigest()
+
+    def folds(self):
+        """
+        The angle, in radians, by which the surface bends across each
+        conditional line: 0 where the two control points lie in one plane
+        with the line, on either side of it, up to pi where they lie on the
+        same side. Computed for every line at once.
+
+        >>> f = FlatMesh(); f.verts = numpy.array([0.0, 0, 0, 0, 0, 1]); f.condEdges = numpy.array([0, 1, 0, 1])
+        >>> f.condControls = numpy.array([1.0, 0, 0, -1, 0, 0, 1, 0, 0, 0, 1, 0])
+        >>> [round(math.degrees(a)) for a in f.folds()]
+        [0, 90]
+        """
+        verts = numpy.asarray(self.verts, dtype=numpy.float64).reshape(-1, 3)
+        ends = numpy.asarray(self.condEdges, dtype=numpy.int64).reshape(-1, 2)
+        controls = numpy.asarray(self.condControls, dtype=numpy.float64).reshape(-1, 2, 3)
+        start = verts[ends[:, 0]]
+        line = verts[ends[:, 1]] - start
+        # Each control point's offset from the line, perpendicular to it
+        offsets = controls - start[:, None, :]
+        along = numpy.einsum('nkj,nj->nk', offsets, line) / numpy.einsum('nj,nj->n', line, line)[:, None]
+        offsets -= along[:, :, None]*line[:, None, :]
+        lengths = numpy.linalg.norm(offsets, axis=2)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            cos = numpy.einsum('nj,nj->n', offsets[:, 0], offsets[:, 1]) / (lengths[:, 0]*lengths[:, 1])
+        # Control points on the line itself say nothing; count them as flat
+        cos = numpy.clip(numpy.nan_to_num(cos, nan=-1.0), -1.0, 1.0)
+        return math.pi - numpy.arccos(cos)
+
+    def withoutDuplicateFaces(self):
+        """
+        A copy without the double-sided faces (those without FACE_CULL) that
+        repeat another double-sided face on the same corners, in either
+        winding, such as a face and its reverse in a file without BFC. Corners
+        are matched by position (to 1e-4 units), since every inlined copy of a
+        file has vertices of its own, and vertices left unused are dropped.
+        Returns self if there is nothing to remove.
+
+        >>> f = FlatMesh('a.dat'); f.verts = numpy.array([0.0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, 0, 0, 1, 0])
+        >>> f.faceVerts = numpy.array([0, 1, 2, 5, 4, 3]); f.faceSizes = numpy.array([3, 3], dtype=numpy.uint8)
+        >>> f.faceSlots = numpy.zeros(2, dtype=numpy.uint16); f.faceFlags = numpy.zeros(2, dtype=numpy.uint8)
+        >>> g = f.withoutDuplicateFaces()
+        >>> g.faceCount, g.vertCount, g.faceVerts.tolist()
+        (1, 3, [0, 1, 2])
+        >>> f.faceFlags[:] = FACE_CULL
+        >>> f.withoutDuplicateFaces() is f
+        True
+        """
+        flags = numpy.asarray(self.faceFlags, dtype=numpy.uint8)
+        doubleSided = numpy.flatnonzero((flags & FACE_CULL) == 0)
+        if len(doubleSided) < 2:
+            return self
+        sizes = numpy.asarray(self.faceSizes, dtype=numpy.int64)
+        faceVerts = numpy.asarray(self.faceVerts, dtype=numpy.int64)
+        ids = self.positionIds()
+
+        # The corners of each face, padded to 4, starting at the lowest id
+        # and going round whichever way reaches the lower neighbour first,
+        # so a face and its reverse come out the same
+        n = sizes[doubleSided, None]
+        starts = (numpy.cumsum(sizes) - sizes)[doubleSided, None]
+        pos = numpy.arange(4)[None, :]
+        corners = ids[faceVerts[starts + numpy.minimum(pos, n-1)]]
+        first = numpy.argmin(numpy.where(pos < n, corners, len(ids)), axis=1)[:, None]
+        rows = numpy.arange(len(doubleSided))[:, None]
+        forward = corners[rows, (first + pos) % n]
+        backward = corners[rows, (first - pos) % n]
+        canonical = numpy.where(forward[:, 1:2] < backward[:, 1:2], forward, backward)
+        canonical[numpy.broadcast_to(pos >= n, canonical.shape)] = -1
+
+        keep = numpy.ones(len(sizes), dtype=bool)
+        keep[doubleSided] = False
+        keep[doubleSided[numpy.unique(canonical, axis=0, return_index=True)[1]]] = True
+        if keep.all():
+            return self
+        PROFILE.count(self.name, 'duplicateFaces', int(len(keep)-keep.sum()))
+        return self.subset(keep, self.edges, self.condEdges, self.condControls)
+
+    def withLinesOnFaces(self):
+        """
+        A copy whose line (type 2) and conditional line ends use the face
+        vertices at the same position (to 1e-4 units), instead of vertices of
+        their own. Every inlined file has its own vertices, so without this
+        the lines of a merged part (from edge primitives, say) could never
+        mark the face edges they lie on. Lines that shrink to a point are
+        dropped, and so are vertices left unused. Returns self if no line
+        moves.
+
+        >>> part = parseLines(["1 16 0 0 0 1 0 0 0 1 0 0 0 1 face.dat", "1 16 0 0 0 1 0 0 0 1 0 0 0 1 line.dat"])
+        >>> files = {'face.dat': parseLines(["3 16 0 0 0 1 0 0 0 1 0"]), 'line.dat': parseLines(["2 24 1 0 0 0 1 0"])}
+        >>> flat = flatten('part.dat', lambda name: (files.get(name, part), name), lambda name: True)
+        >>> edge = sorted(flat.edges.tolist())
+        >>> faceEdges = [sorted(pair) for pair in zip(flat.faceVerts.tolist(), numpy.roll(flat.faceVerts, -1).tolist())]
+        >>> flat.vertCount, edge in faceEdges
+        (3, True)
+        """
+        ids = self.positionIds()
+        faceVerts = numpy.asarray(self.faceVerts, dtype=numpy.int64)
+        # The first face vertex at each position
+        owner = numpy.full(ids.max()+1 if len(ids) else 0, -1, dtype=numpy.int64)
+        owner[ids[faceVerts[::-1]]] = faceVerts[::-1]
+        snap = numpy.where(owner[ids] >= 0, owner[ids], numpy.arange(len(ids)))
+        edges = snap[numpy.asarray(self.edges, dtype=numpy.int64)].reshape(-1, 2)
+        condEdges = snap[numpy.asarray(self.condEdges, dtype=numpy.int64)].reshape(-1, 2)
+        if (numpy.array_equal(edges.ravel(), self.edges) and
+                numpy.array_equal(condEdges.ravel(), self.condEdges)):
+            return self
+        keepCond = condEdges[:, 0] != condEdges[:, 1]
+        condControls = numpy.asarray(self.condControls, dtype=numpy.float64).reshape(-1, 6)[keepCond]
+        return self.subset(numpy.ones(self.faceCount, dtype=bool),
+                           edges[edges[:, 0] != edges[:, 1]].ravel(),
+                           condEdges[keepCond].ravel(), condControls.ravel())
+
+    def positionIds(self):
+        # The same id for every vertex at the same position (to 1e-4 units);
+        # adding 0.0 turns -0.0 into 0.0
+        verts = numpy.asarray(self.verts, dtype=numpy.float64).reshape(-1, 3)
+        return numpy.unique(numpy.round(verts, 4) + 0.0, axis=0, return_inverse=True)[1].reshape(-1)
+
+    def subset(self, keep, edges, condEdges, condControls):
+        # A copy with only the faces in keep and the given lines, without
+        # the vertices none of them use
+        flat = FlatMesh(self.name)
+        verts = numpy.asarray(self.verts, dtype=numpy.float64).reshape(-1, 3)
+        faceVerts = numpy.asarray(self.faceVerts, dtype=numpy.int64)[numpy.repeat(keep, self.faceSizes.astype(numpy.int64))]
+        edges = numpy.asarray(edges, dtype=numpy.int64)
+        condEdges = numpy.asarray(condEdges, dtype=numpy.int64)
+        used = numpy.zeros(len(verts), dtype=bool)
+        for indices in (faceVerts, edges, condEdges):
+            used[indices] = True
+        remap = (numpy.cumsum(used) - 1).astype(numpy.int32)
+        flat.verts = verts[used].ravel()
+        flat.faceVerts = remap[faceVerts]
+        flat.faceSizes = numpy.asarray(self.faceSizes)[keep]
+        flat.faceSlots = numpy.asarray(self.faceSlots)[keep]
+        flat.faceFlags = numpy.asarray(self.faceFlags)[keep]
+        flat.edges = remap[edges]
+        flat.condEdges = remap[condEdges]
+        flat.condControls = numpy.asarray(condControls, dtype=numpy.float64)
+        for attr in ('slotColors', 'colours', 'certified', 'hasData', 'deps', 'missing'):
+            setattr(flat, attr, getattr(self, attr))
+        return flat
+
+    def reversedFaceVerts(self):
+        """
+        faceVerts with the corners of every face in the opposite order.
+
+        >>> f = FlatMesh(); f.faceVerts = numpy.array([0, 1, 2, 3, 4, 5, 6]); f.faceSizes = numpy.array([3, 4])
+        >>> f.reversedFaceVerts().tolist()
+        [2, 1, 0, 6, 5, 4, 3]
+        """
+        sizes = self.faceSizes.astype(numpy.int64)
+        ends = numpy.cumsum(sizes)
+        faceOf = numpy.repeat(numpy.arange(len(sizes)), sizes)
+        pos = numpy.arange(len(self.faceVerts))
+        return self.faceVerts[ends[faceOf] - sizes[faceOf] + ends[faceOf] - 1 - pos]
+
+@profiled('merging')
+def flatten(fname, load, isPart, smooth=False, gap=0.0, memo=None, studless=False):
+    """
+    Inline every reference of a file into one FlatMesh, the way merged parts
+    are built: child faces take the reference's color where they inherit it,
+    are reversed where the reference is inverted or mirrored, and sub-parts
+    are scaled by 1-gap to leave a seam.
+
+    All the placements of each distinct child are transformed together with
+    one batched matrix multiply, and the result is concatenated once at the
+    end, so the cost grows linearly with the number of references.
+
+    load(fname) returns (LDrawFile, path) like Library.load, with a path of
+    None for files that did not come from the library. Returns None if the
+    file cannot be found. With studless, stud primitives are left out.
+
+    Faces a file without BFC places can't be culled, except those of parts,
+    which start a BFC chain of their own:
+
+    >>> files = {'face.dat': parseLines(["0 BFC CERTIFY", "3 16 0 0 0 1 0 0 0 1 0"])}
+    >>> load = lambda name: (files[name], None)
+    >>> for child, isPart in (('face.dat', lambda name: False), ('face.dat', lambda name: True)):
+    ...     files['m.ldr'] = parseLines(["1 16 0 0 0 1 0 0 0 1 0 0 0 1 " + child])
+    ...     print(flatten('m.ldr', load, isPart).faceFlags & FACE_CULL)
+    [0]
+    [1]
+    """
+    if memo is None:
+        memo = {}
+    if fname in memo:
+        return memo[fname]
+    parsed, path = load(fname)
+    if parsed is None:
+        memo[fname] = None
+        return None
+
+    own = FlatMesh.fromFile(parsed, smooth and isRoundPrimitive(fname))
+    flat = FlatMesh(fname)
+    flat.colours = own.colours
+    flat.deps.add(path)
+    flat.hasData = parsed.hasData
+    certified = parsed.certified
+    slotColors = own.slotColors.tolist()
+
+    def slot(color):
+        if color in (16, 24):
+            return 0
+        if color not in slotColors:
+            slotColors.append(color)
+        return slotColors.index(color)
+
+    # Gather the placements of each child first
+    placements = {}
+    for idx, child in enumerate(parsed.refNames):
+        if studless and isStud(child):
+            continue
+        childFlat = flatten(child, load, isPart, smooth, gap, memo, studless)
+        if childFlat is None:
+            flat.missing.add(child)
+            continue
+        flat.deps |= childFlat.deps
+        flat.missing |= childFlat.missing
+        if childFlat.hasData:
+            placements.setdefault(child, []).append(idx)
+
+    verts = [own.verts.reshape(-1, 3)]
+    faceVerts = [own.faceVerts]
+    faceSizes = [own.faceSizes]
+    faceSlots = [own.faceSlots]
+    faceFlags = [own.faceFlags]
+    edges = [own.edges]
+    condEdges = [own.condEdges]
+    condControls = [own.condControls.reshape(-1, 3)]
+    offset = own.vertCount
+    if placements:
+        matrices = numpy.array(parsed.refMatrices, dtype=numpy.float64).reshape(-1, 3, 4)
+        refFlags = numpy.array(parsed.refFlags, dtype=numpy.uint8)
+        refInvert = (refFlags & REF_INVERT) != 0
+        # References from a file without BFC, or made under BFC NOCLIP, can't
+        # be culled, whatever the files they place say. Parts start a chain
+        # of their own.
+        refNoCull = ((refFlags & REF_NOCLIP) != 0) | (not parsed.certified)
+    for child, idxs in placements.items():
+        childFlat = memo[child]
+        idxs = numpy.array(idxs)
+        count = len(idxs)
+        m = matrices[idxs]
+        with PROFILE.phase('bfc'):
+            invert = refInvert[idxs] ^ (numpy.linalg.det(m[:, :, :3]) < 0)
+            reversedCorners = childFlat.reversedFaceVerts() if invert.any() else childFlat.faceVerts
+        if gap and isPart(child) and not isSubpart(child):
+            m[:, :, :3] *= 1.0-gap
+
+        childVerts = childFlat.verts.reshape(-1, 3)
+        verts.append((numpy.einsum('kij,nj->kni', m[:, :, :3], childVerts) + m[:, None, :, 3]).reshape(-1, 3))
+        offsets = (offset + numpy.arange(count, dtype=numpy.int32)*len(childVerts))[:, None]
+        offset += count*len(childVerts)
+
+        corners = numpy.where(invert[:, None], reversedCorners[None, :], childFlat.faceVerts[None, :])
+        faceVerts.append((corners + offsets).ravel())
+        faceSizes.append(numpy.tile(childFlat.faceSizes, count))
+        childFlags = numpy.tile(childFlat.faceFlags, (count, 1))
+        if not (isPart(child) and not isSubpart(child)):
+            childFlags[refNoCull[idxs]] &= ~numpy.uint8(FACE_CULL)
+        faceFlags.append(childFlags.ravel())
+        edges.append((childFlat.edges[None, :] + offsets).ravel())
+        condEdges.append((childFlat.condEdges[None, :] + offsets).ravel())
+        childControls = childFlat.condControls.reshape(-1, 3)
+        condControls.append((numpy.einsum('kij,nj->kni', m[:, :, :3], childControls) + m[:, None, :, 3]).reshape(-1, 3))
+
+        # Slot 0 of the child takes the color of each reference; the others
+        # keep their own colors
+        slotMap = numpy.empty((count, len(childFlat.slotColors)), dtype=numpy.uint16)
+        slotMap[:, 0] = [slot(color) for color in numpy.array(parsed.refColors)[idxs].tolist()]
+        slotMap[:, 1:] = [slot(color) for color in childFlat.slotColors[1:].tolist()]
+        faceSlots.append(slotMap[:, childFlat.faceSlots].ravel())
+
+        for colour in childFlat.colours:
+            if colour not in flat.colours:
+                flat.colours.append(colour)
+        certified = certified and childFlat.certified
+
+    flat.verts = numpy.concatenate(verts).ravel()
+    flat.faceVerts = numpy.concatenate(faceVerts).astype(numpy.int32, copy=False)
+    flat.faceSizes = numpy.concatenate(faceSizes)
+    flat.faceSlots = numpy.concatenate(faceSlots).astype(numpy.uint16, copy=False)
+    flat.faceFlags = numpy.concatenate(faceFlags)
+    flat.edges = numpy.concatenate(edges).astype(numpy.int32, copy=False)
+    flat.condEdges = numpy.concatenate(condEdges).astype(numpy.int32, copy=False)
+    flat.condControls = numpy.concatenate(condControls).ravel()
+    flat.slotColors = numpy.array(slotColors, dtype=numpy.int32)
+    flat.certified = bool(certified)
+    if placements and isPart(fname):
+        # Copies of faces from different files of a part; those within one
+        # file were dropped while parsing. Faces of parts that merely touch
+        # in a model are left alone.
+        flat = flat.withoutDuplicateFaces().withLinesOnFaces()
+    memo[fname] = flat
+    return flat
+
+def scanParts(fname, load, isMerged):
+    """
+    Names of the files a model places as whole merged parts, found by
+    walking its references (and those of its submodels) without reading the
+    parts themselves.
+    """
+    parts = set()
+    seen = {fname}
+    pending = [fname]
+    while pending:
+        parsed, path = load(pending.pop())
+        if parsed is None:
+            continue
+        for child in parsed.refNames:
+            if child in seen:
+                continue
+            seen.add(child)
+            if isMerged(child):
+                parts.add(child)
+            else:
+                pending.append(child)
+    return parts
+
+### WORKER POOL ###
+
+_WORKER = None
+
+def _initWorker(ldrawDir, hires, lowres, tolerance, smooth, gap, index, studless):
+    global _WORKER
+    # Every worker keeps its own library and flattened sub-parts, so shared
+    # primitives are only read once per process
+    _WORKER = Library(ldrawDir, hires, lowres, tolerance, index), smooth, gap, {}, studless
+
+def _flattenChunk(names):
+    library, smooth, gap, memo, studless = _WORKER
+    return [(name, flatten(name, library.load, library.isPart, smooth, gap, memo, studless)) for name in names]
+
+def flattenParts(names, ldrawDir, hires=False, lowres=False, tolerance=None,
+                 smooth=False, gap=0.0, workers=None, executable=None, index=None,
+                 studless=False):
+    """
+    Flatten library parts in a pool of worker processes. Returns a dict of
+    names to FlatMeshes (or None for parts that cannot be found).
+
+    The workers do not need Blender; executable is the Python interpreter to
+    start them with, if not sys.executable (which is Blender itself in older
+    releases). Passing the LibraryIndex already in use spares every worker
+    from walking the library again.
+    """
+    names = sorted(names)
+    if not names:
+        return {}
+    workers = workers or os.cpu_count() or 1
+    # Several chunks per worker, so that a few complex parts don't leave the
+    # other workers idle at the end
+    chunkSize = max(1, len(names)//(workers*4))
+    chunks = [names[i:i+chunkSize] for i in range(0, len(names), chunkSize)]
+    context = multiprocessing.get_context('spawn')
+    if executable is not None:
+        context.set_executable(executable)
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(
+            min(workers, len(chunks)), mp_context=context, initializer=_initWorker,
+            initargs=(ldrawDir, hires, lowres, tolerance, smooth, gap, index, studless)) as pool:
+        for chunk in pool.map(_flattenChunk, chunks):
+            results.update(chunk)
+    return results
+
+### PART CACHE ###
+
+def cacheDir():
+    """
+    Where parsed parts are cached between sessions: $LDRAW_CACHE_DIR, or the
+    platform's user cache directory.
+    """
+    if os.environ.get('LDRAW_CACHE_DIR'):
+        return os.environ['LDRAW_CACHE_DIR']
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser(os.path.join('~', 'Library', 'Caches'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache')))
+    return os.path.join(base, 'blender-ldraw')
+
+def fileStamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        archive, member = archiveMember(path)
+        if archive is None:
+            raise
+        return archive.stamp(member)
+    return [st.st_mtime_ns, st.st_size]
+
+class PartCache(object):
+    """
+    On-disk cache of flattened parts. Each entry is one file: a small JSON
+    header (options, dependency stamps, array lengths) followed by the
+    FlatMesh arrays, 8-byte aligned, so that loading maps the file and hands
+    out read-only arrays over the mapping without copying or parsing
+    anything.
+
+    Entries are invalid once the mtime or size of any file they were built
+    from changes, or once find(name) finds a file that was missing when they
+    were built (without find, entries with missing files are never used).
+    If the cache directory can't be written, the cache does nothing.
+
+    >>> with warnings.catch_warnings(record=True) as caught:
+    ...     cache = PartCache(os.path.join(os.devnull, 'cache'))
+    >>> cache.directory, cache.get('3001.dat', {}), len(caught)
+    (None, None, 1)
+
+    >>> import tempfile
+    >>> library = {}
+    >>> cache = PartCache(tempfile.mkdtemp(), find=library.get)
+    >>> flat = FlatMesh('a.dat')
+    >>> flat.missing.add('b.dat')
+    >>> cache.put('a.dat', [], flat)
+    >>> cache.get('a.dat', []).missing
+    {'b.dat'}
+    >>> library['b.dat'] = os.path.join('parts', 'b.dat')
+    >>> cache.get('a.dat', []) is None
+    True
+    """
+    MAGIC = b'LDRC'
+    VERSION = 6
+    ARRAYS = (('verts', '<f8'), ('faceVerts', '<i4'), ('faceSizes', 'u1'),
+              ('faceSlots', '<u2'), ('faceFlags', 'u1'), ('edges', '<i4'),
+              ('condEdges', '<i4'), ('condControls', '<f8'), ('slotColors', '<i4'))
+    HEADER = struct.Struct('<4sII')
+
+    def __init__(self, directory=None, find=None):
+        self.directory = cacheDir() if directory is None else directory
+        self.find = find
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError as e:
+            self.disable(e)
+
+    def disable(self, e):
+        warnings.warn("Could not use part cache: {0}".format(e))
+        self.directory = None
+
+    def entryPath(self, fname, options):
+        key = json.dumps([self.VERSION, fname, options], sort_keys=True)
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.bin')
+
+    def entry(self, fname, options):
+        # The mapped entry and its header, if it is still valid
+        if self.directory is None:
+            return None, None, 0
+        path = self.entryPath(fname, options)
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return None, None, 0
+        with f:
+            try:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return None, None, 0
+        try:
+            magic, version, metaLen = self.HEADER.unpack_from(buf, 0)
+            if magic != self.MAGIC or version != self.VERSION:
+                return None, None, 0
+            meta = json.loads(bytes(buf[self.HEADER.size:self.HEADER.size+metaLen]).decode('utf-8'))
+            for dep, stamp in meta['deps']:
+                if fileStamp(dep) != stamp:
+                    return None, None, 0
+            if meta['missing'] and (self.find is None or any(self.find(name) is not None for name in meta['missing'])):
+                return None, None, 0
+        except (OSError, ValueError, KeyError, struct.error):
+            return None, None, 0
+        return buf, meta, metaLen
+
+    @profiled('cache')
+    def get(self, fname, options):
+        """
+        Returns the cached FlatMesh, or None if there is no valid entry.
+        options must describe everything other than the library files that
+        affects the result.
+        """
+        buf, meta, metaLen = self.entry(fname, options)
+        if buf is None:
+            return None
+        flat = FlatMesh(fname)
+        offset = self.align(self.HEADER.size+metaLen)
+        for (attr, dtype), count in zip(self.ARRAYS, meta['counts']):
+            setattr(flat, attr, numpy.frombuffer(buf, dtype, count, offset))
+            offset = self.align(offset+count*numpy.dtype(dtype).itemsize)
+        flat.colours = [(name, line) for name, line in meta['colours']]
+        flat.certified = meta['certified']
+        flat.hasData = meta['hasData']
+        flat.deps = set(dep for dep, stamp in meta['deps'])
+        flat.missing = set(meta['missing'])
+        return flat
+
+    @profiled('cache')
+    def bounds(self, fname, options):
+        """
+        FlatMesh.bounds of a cached entry, read from its header alone. None
+        if there is no valid entry, or it has no bounds.
+        """
+        buf, meta, metaLen = self.entry(fname, options)
+        return None if buf is None else meta.get('bounds')
+
+    @profiled('cache')
+    def deps(self, fname, options):
+        """
+        The [file, stamp] pairs a valid entry was built from, read from its
+        header alone. None if there is no valid entry.
+        """
+        buf, meta, metaLen = self.entry(fname, options)
+        return None if buf is None else meta['deps']
+
+    @profiled('cache')
+    def put(self, fname, options, flat):
+        if self.directory is None:
+            return
+        try:
+            deps = [(dep, fileStamp(dep)) for dep in sorted(flat.deps)]
+        except OSError:
+            return
+        arrays = [getattr(flat, attr) for attr, code in self.ARRAYS]
+        meta = json.dumps({'deps': deps,
+                           'missing': sorted(flat.missing),
+                           'counts': [len(a) for a in arrays],
+                           'colours': flat.colours,
+                           'certified': flat.certified,
+                           'hasData': flat.hasData,
+                           'bounds': flat.bounds()}).encode('utf-8')
+        path = self.entryPath(fname, options)
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, self.VERSION, len(meta)))
+                f.write(meta)
+                for (attr, dtype), a in zip(self.ARRAYS, arrays):
+                    f.write(b'\0'*(self.align(f.tell())-f.tell()))
+                    f.write(numpy.ascontiguousarray(a, dtype=dtype).tobytes())
+            os.replace(tmp, path)
+        except OSError as e:
+            # Disk full or read-only; give up on caching rather than fail
+            # every part of the import
+            self.disable(e)
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    @staticmethod
+    def align(offset):
+        return (offset+7) & ~7
+
+def main(paths):
+    lines = faces = refs = 0
+    start = time.perf_counter()
+    for path in paths:
+        with open(path, 'rb') as f:
+            lines += sum(1 for line in f)
+        for parsed in parseFile(path)[1].values():
+            faces += parsed.faceCount
+            refs += parsed.refCount
+    elapsed = time.perf_counter()-start
+    print("Parsed {0} files ({1} lines, {2} faces, {3} references) in {4:.4} seconds, {5:.0f} lines/s".format(
+        len(paths), lines, faces, refs, elapsed, lines/elapsed if elapsed else 0.0))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])